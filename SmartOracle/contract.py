@@ -5,8 +5,13 @@ from eth_abi import decode
 import sys
 from storageExtractor.storage import StorageExtractor
 from storageExtractor.storageTest import StateVariableExtractor
+from varDictStore import VarDictStore
+from traceTable import TraceTable
+from storageOverlay import StorageHistory, StorageOverlay
 from web3 import Web3
 import math
+import numpy as np
+from multiprocessing import get_context
 sys.set_int_max_str_digits(0)
 
 def slotAdd(slot:str, num:int) -> str:
@@ -44,6 +49,90 @@ def getTxKey(e):
 def getBlock(block_tx):
     return int(block_tx.split('_')[0])
 
+# for parallel ingestion, each worker process reads txs with the forked contract
+_ingestContract = None
+
+def _initIngestWorker(contract):
+    global _ingestContract
+    _ingestContract = contract
+
+def _ingestTx(args):
+    txPath, excludePartialErr = args
+    return _ingestContract.readTxToVarDict(txPath, excludePartialErr=excludePartialErr)
+
+def pruneTokenBalance(points):
+    # keep the tokens and holders with a positive balance at some point, in one pass over the balances
+    positiveHolders = dict() # map token => the holders with a positive balance
+    for point in points:
+        for token, balanceMap in points[point]["tokenBalance"].items():
+            if token not in positiveHolders:
+                positiveHolders[token] = set()
+            for addr, balance in balanceMap.items():
+                if balance and balance > 0:
+                    positiveHolders[token].add(addr)
+
+    for point in points:
+        newTokenBalance = dict()
+        for token, balanceMap in points[point]["tokenBalance"].items():
+            if len(positiveHolders[token]) > 0:
+                newTokenBalance[token] = {addr: balance for addr, balance in balanceMap.items() if addr in positiveHolders[token]}
+        points[point]["tokenBalance"] = newTokenBalance
+
+"""
+the token balances of the points of a call, one (points x holders) array per token and the totals of its points summed once
+the holders of a token are the columns shared by all the points, a holder without a balance at a point reads 0
+the arrays hold python ints (object dtype), as the balances are uint256, the balance of a role is read when it is asked for
+"""
+class TokenBalanceMatrix(object):
+
+    def __init__(self, points):
+        self.rows = dict() # map point => row
+        self.holders = dict() # map token => {addr: column}
+        self.balances = dict() # map token => array of the balances by (row, column)
+        self.totals = dict() # map token => array of the sums of the balances by row
+        self.present = dict() # map token => array of whether the token has holders by row
+        self.tokens = dict() # map point => [token], the tokens with holders in the order of the point
+        for point in points:
+            self.rows[point] = len(self.rows)
+            self.tokens[point] = list()
+            for token, balanceMap in points[point]["tokenBalance"].items():
+                if len(balanceMap) == 0:
+                    continue
+                if token not in self.holders:
+                    self.holders[token] = dict()
+                holderIndex = self.holders[token]
+                for addr in balanceMap:
+                    if addr not in holderIndex:
+                        holderIndex[addr] = len(holderIndex)
+                self.tokens[point].append(token)
+
+        for token, holderIndex in self.holders.items():
+            self.balances[token] = np.zeros((len(self.rows), len(holderIndex)), dtype=object)
+            self.totals[token] = np.zeros(len(self.rows), dtype=object)
+            self.present[token] = np.zeros(len(self.rows), dtype=bool)
+        for point, row in self.rows.items():
+            for token in self.tokens[point]:
+                balanceMap = points[point]["tokenBalance"][token]
+                holderIndex = self.holders[token]
+                balances = self.balances[token]
+                for addr, balance in balanceMap.items():
+                    balances[row, holderIndex[addr]] = balance
+                self.totals[token][row] = sum(balanceMap.values())
+                self.present[token][row] = True
+
+    def hasToken(self, point, token):
+        return token in self.present and bool(self.present[token][self.rows[point]])
+
+    def getTotal(self, point, token):
+        return self.totals[token][self.rows[point]]
+
+    def getBalance(self, point, token, addr):
+        # 0 if addr does not hold token at point
+        column = self.holders[token].get(addr)
+        if column == None:
+            return 0
+        return self.balances[token][self.rows[point], column]
+
 def getByteNum(var_type):
     if "int" in var_type:
         tmpNum = int(var_type.split("int")[1])
@@ -60,6 +149,168 @@ def getByteNum(var_type):
     return 32
 
 
+"""
+the parts of the traceDict of a call, each part is built on first use and cached
+withCall means the method and event variables are in the trace (function and branch level)
+"""
+class TraceBuilder(object):
+
+    def __init__(self, contract, var_dict, slotPlan):
+        self.contract = contract
+        self.var_dict = var_dict
+        self.slotPlan = slotPlan
+        self.baseTraceDict = dict()
+        # self.baseTraceDict["tx.origin"] = (var_dict["tx.origin"], "address")
+        self.baseTraceDict["callee"] = (var_dict["to"], "address")
+        self.baseTraceDict["msg.sender"] = (var_dict["from"], "address")
+        self.baseTraceDict["msg.value"] = (var_dict["value"], "uint")
+        self.baseTraceDict["block.timestamp"] = (var_dict["timestamp"],"uint")
+        self.baseTraceDict["block.number"] = (var_dict["blockNumber"],"uint")
+        self.methodTraceDict = None
+        self.eventTraceDict = None
+        self.varTraceDict = dict()
+        self.keyAddrMap = dict()
+        self.tokenMatrix = None
+        self.tokenTraceDict = dict()
+        self.changeTraceDict = dict()
+
+    def getMethod(self):
+        if self.methodTraceDict == None:
+            methodTraceDict = dict()
+            for argName, argContent in self.var_dict["args"].items():
+                if argName == "rawbytes":
+                    methodTraceDict['method.rawbytes'] = (argContent, "bytes")
+                else:
+                    var_info = self.contract.txExtractor.functionAbi[self.var_dict['sig']]["argFormatDict"][argName]
+                    methodTraceDict[f"method.{argName}"] = self.contract.getMethodArgDtrace(var_info['type'], var_info, argContent)
+            self.methodTraceDict = self.contract.flatDtrace(methodTraceDict)
+        return self.methodTraceDict
+
+    def getEvents(self):
+        # when exsiting more than one event with the same name, only record the first event
+        if self.eventTraceDict == None:
+            eventTraceDict = dict()
+            for event in self.var_dict["events"]:
+                sig = event['sig']
+                for argName, argContent in event["args"].items():
+                    var_info = self.contract.txExtractor.eventAbi[sig]["argFormatDict"][argName]
+                    eventTraceDict[f'event.{event["name"]}.{argName}'] = self.contract.getMethodArgDtrace(var_info['type'], var_info, argContent)
+            self.eventTraceDict = self.contract.flatDtrace(eventTraceDict)
+        return self.eventTraceDict
+
+    def getVariables(self, point):
+        if point not in self.varTraceDict:
+            stateVariableDtraceDict = self.contract.getStateVariableDtrace(self.var_dict["points"][point]["storage"], self.slotPlan)
+            varTraceDict = dict()
+            # extract traceDict from dtrace
+            if stateVariableDtraceDict != None:
+                for var_name in stateVariableDtraceDict:
+                    varTraceDict.update(self.contract.flatDtraceUtil(f"variable.{var_name}", stateVariableDtraceDict[var_name]))
+            self.varTraceDict[point] = varTraceDict
+        return self.varTraceDict[point]
+
+    def getKeyAddrMap(self, withCall):
+        if withCall not in self.keyAddrMap:
+            traceDictList = [self.baseTraceDict]
+            if withCall:
+                traceDictList += [self.getMethod(), self.getEvents()]
+            traceDictList.append({f"pre({var_name})": var_value for var_name, var_value in self.getVariables("pre").items()})
+            keyAddrMap = dict()
+            for traceDict in traceDictList:
+                for var_name, var_value in traceDict.items():
+                    if isinstance(var_value, tuple) and isinstance(var_value[0],str) and var_value[1] == "address":
+                        # only selecting these addresses
+                        if var_name.startswith("event.") or var_name.startswith("method.") or var_name.startswith("pre(variable.") or var_name in ["msg.sender", "callee", "tx.origin"]:
+                            keyAddrMap[var_name] = var_value[0]
+            self.keyAddrMap[withCall] = keyAddrMap
+        return self.keyAddrMap[withCall]
+
+    def getTokenMatrix(self):
+        if self.tokenMatrix == None:
+            self.tokenMatrix = TokenBalanceMatrix(self.var_dict['points'])
+        return self.tokenMatrix
+
+    def getTokens(self, point, withCall):
+        if (point, withCall) not in self.tokenTraceDict:
+            tokenDtraceDict = dict()
+            self.contract.getTokenBalanceDtrace(self.getTokenMatrix(), point, self.getKeyAddrMap(withCall), tokenDtraceDict)
+            self.tokenTraceDict[(point, withCall)] = tokenDtraceDict
+        return self.tokenTraceDict[(point, withCall)]
+
+    def getToken(self, point, withCall, var_name):
+        # one entry of getTokens, tokenBalance.[token][role], without projecting the other roles
+        if (point, withCall) in self.tokenTraceDict:
+            return self.tokenTraceDict[(point, withCall)].get(var_name)
+        if not (var_name.startswith("tokenBalance.[") and var_name.endswith("]")) or "][" not in var_name:
+            return None
+        token, role = var_name[len("tokenBalance.["):-1].split("][", 1)
+        tokenMatrix = self.getTokenMatrix()
+        if not tokenMatrix.hasToken(point, token):
+            return None
+        if role == "all":
+            return (tokenMatrix.getTotal(point, token), 'uint')
+        keyAddrMap = self.getKeyAddrMap(withCall)
+        if role not in keyAddrMap:
+            return None
+        return (tokenMatrix.getBalance(point, token, keyAddrMap[role]), 'uint')
+
+    def getPoint(self, point, withCall):
+        pointDtraceDict = dict(self.getVariables(point))
+        pointDtraceDict.update(self.getTokens(point, withCall))
+        return pointDtraceDict
+
+    def getChanges(self, point, withCall):
+        if (point, withCall) not in self.changeTraceDict:
+            self.changeTraceDict[(point, withCall)] = self.contract.getChangeVarDtrace(point, self.getPoint(point, withCall), self.getPoint("pre", withCall))
+        return self.changeTraceDict[(point, withCall)]
+
+"""
+traceDict of a call for checking, the variables are only decoded when an invariant asks for them
+"""
+class LazyTraceDict(object):
+
+    def __init__(self, builder, level):
+        self.builder = builder
+        self.level = level
+        self.withCall = level in ["function", "branch"]
+        self.points = list(builder.var_dict["points"]) if level == "branch" else ["pre","post"]
+
+    def lookup(self, var_name):
+        # None when var_name is not in the traceDict
+        builder = self.builder
+        if var_name in builder.baseTraceDict:
+            return builder.baseTraceDict[var_name]
+        elif var_name.startswith("method."):
+            return builder.getMethod().get(var_name) if self.withCall else None
+        elif var_name.startswith("event."):
+            return builder.getEvents().get(var_name) if self.withCall else None
+        elif var_name.startswith("change."):
+            point = var_name[len("change."):].split("(")[0]
+            if point != "pre" and point in self.points:
+                return builder.getChanges(point, self.withCall).get(var_name)
+            return None
+        elif "(" in var_name and var_name.endswith(")"):
+            point = var_name.split("(")[0]
+            if point in self.points:
+                point_var_name = var_name[len(point)+1:-1]
+                if point_var_name.startswith("tokenBalance."):
+                    return builder.getToken(point, self.withCall, point_var_name)
+                return builder.getVariables(point).get(point_var_name)
+        return None
+
+    def __contains__(self, var_name):
+        return self.lookup(var_name) != None
+
+    def __getitem__(self, var_name):
+        var_value = self.lookup(var_name)
+        if var_value == None:
+            raise KeyError(var_name)
+        return var_value
+
+    def get(self, var_name, default=None):
+        var_value = self.lookup(var_name)
+        return default if var_value == None else var_value
+
 class Contract(object):
 
     def __init__(self, proxyAddr, contractConfig, sourcePath, outputPath):
@@ -74,6 +325,8 @@ class Contract(object):
         self.outputPath = outputPath
         self.storageLayoutDict = dict()
         self.stateVariableExtractor = dict()
+        # the var_names and types of the dtraces, the traceDicts are kept as TraceRows
+        self.traceTable = TraceTable()
         if not os.path.exists(outputPath):
             os.mkdir(outputPath)
 
@@ -97,8 +350,7 @@ class Contract(object):
 
     def readTxToVarDict(self, txPath, excludePartialErr=False):
         var_dict_list = list()
-        with open(txPath,'r') as f:
-            tx = json.load(f)
+        tx = self.txExtractor.loadExTx(txPath)
 
         callList = self.txExtractor.extractExTx(tx, excludePartialErr)
 
@@ -146,32 +398,7 @@ class Contract(object):
                 var_dict["points"][postPoint]["storage"] = subCall["postAlloc"][self.address]["storage"] if self.address in subCall["postAlloc"] and "storage" in subCall["postAlloc"][self.address] else {}
 
             # remove the abandunt token and address
-            tokenAddrDict = dict()
-            tokenDict = dict()
-            for point in var_dict["points"]:
-                for token in var_dict["points"][point]["tokenBalance"]:
-                    if token not in tokenAddrDict:
-                        tokenAddrDict[token] = dict()
-                    if token not in tokenDict:
-                        tokenDict[token] = dict()
-                    for addr in var_dict["points"][point]["tokenBalance"][token]:
-                        if addr not in tokenAddrDict[token]:
-                            tokenAddrDict[token][addr] = False
-                        if var_dict["points"][point]["tokenBalance"][token][addr] and var_dict["points"][point]["tokenBalance"][token][addr] > 0:
-                            tokenAddrDict[token][addr] = True
-                            tokenDict[token] = True
-
-            for point in var_dict["points"]:
-                newTokenBalance = dict()
-                for token in var_dict["points"][point]["tokenBalance"]:
-                    # check if abandunt token
-                    if tokenDict[token]:
-                        newTokenBalance[token] = dict()
-                        for addr in var_dict["points"][point]["tokenBalance"][token]:
-                            # check if abandunt address
-                            if tokenAddrDict[token][addr]:
-                                newTokenBalance[token][addr] = var_dict["points"][point]["tokenBalance"][token][addr]
-                var_dict["points"][point]["tokenBalance"] = newTokenBalance
+            pruneTokenBalance(var_dict["points"])
 
             var_dict_list.append(var_dict)
         
@@ -179,15 +406,15 @@ class Contract(object):
     
     """
     read var_dict
+    processNum > 1 parses and decodes the tx files in a process pool, the results are consumed in the order of toRoadTxs
     """
-    def readVarDict(self, startBlock, endBlock, txNum, mode, txPath, dumpBool = True, excludePartialErr=False, givenTxList=[]):
+    def readVarDict(self, startBlock, endBlock, txNum, mode, txPath, dumpBool = True, excludePartialErr=False, givenTxList=[], processNum=1):
 
-        exist_var_dict_list = list()
+        store = VarDictStore(self.outputPath, mode)
         var_dict_path = f"{mode}_var_dict.json"
-        if os.path.exists(f"{self.outputPath}/{var_dict_path}"):
-            print(f"loading {var_dict_path}")
-            with open(f"{self.outputPath}/{var_dict_path}", "r") as f:
-                exist_var_dict_list = json.load(f)
+        if not store.exists() and os.path.exists(f"{self.outputPath}/{var_dict_path}"):
+            print(f"importing {var_dict_path}")
+            store.importJson(f"{self.outputPath}/{var_dict_path}")
         
         if len(givenTxList) > 0:
             tx_name_list = givenTxList
@@ -195,16 +422,16 @@ class Contract(object):
             tx_name_list = ["_".join(x.replace(".json","").split('_')[:2]) for x in os.listdir(txPath)]
         tx_name_list = [x for x in tx_name_list if getBlock(x) >= startBlock and getBlock(x) <= endBlock]
 
-        tx_name_set = set(tx_name_list)
         toRoadTxs = set(tx_name_list)
 
+        # only read the cached txs in the block window
+        existTxs = [x for x in toRoadTxs if x in store]
+        if len(existTxs) > 0:
+            print(f"loading {len(existTxs)} txs from {store.path}")
         return_var_dict_list = list()
-        for exist_tx in exist_var_dict_list:
-            block_tx = f'{exist_tx["blockNumber"]}_{exist_tx["position"]}'
-            if block_tx in tx_name_set:
-                return_var_dict_list.append(exist_tx)
-                if block_tx in toRoadTxs:
-                    toRoadTxs.remove(block_tx)
+        for var_dict_list in store.load(existTxs).values():
+            return_var_dict_list.extend(var_dict_list)
+        toRoadTxs.difference_update(existTxs)
         
         toRoadTxs = list(toRoadTxs)
         if mode == "mine":
@@ -214,19 +441,34 @@ class Contract(object):
         if len(toRoadTxs) > 0:
             txCount = len(return_var_dict_list)
             new_var_dict_list = list()
-            for tx_name in toRoadTxs:
-                var_dict_list = self.readTxToVarDict(f"{txPath}/{tx_name}.json", excludePartialErr=excludePartialErr)
-                new_var_dict_list.extend(var_dict_list)
-                txCount += int(len(new_var_dict_list) > 0)
-                if txCount >= txNum:
-                    break
+            newTxDict = dict()
+            txArgsList = [(f"{txPath}/{tx_name}.json", excludePartialErr) for tx_name in toRoadTxs]
+            if processNum > 1:
+                # fork, so that the workers share the loaded abi and storage layout
+                pool = get_context("fork").Pool(processNum, initializer=_initIngestWorker, initargs=(self,))
+                txResults = pool.imap(_ingestTx, txArgsList, chunksize=4)
+            else:
+                pool = None
+                txResults = (self.readTxToVarDict(txFile, excludePartialErr=excludeErr) for txFile, excludeErr in txArgsList)
+            try:
+                for tx_name, var_dict_list in zip(toRoadTxs, txResults):
+                    new_var_dict_list.extend(var_dict_list)
+                    if len(var_dict_list) > 0:
+                        newTxDict[tx_name] = var_dict_list
+                    txCount += int(len(new_var_dict_list) > 0)
+                    if txCount >= txNum:
+                        break
+            finally:
+                if pool != None:
+                    # drop the txs parsed ahead of the cutoff, also when a tx fails
+                    pool.terminate()
+                    pool.join()
             print(f"Load Txs: {len(new_var_dict_list)}")
 
             return_var_dict_list.extend(new_var_dict_list)
             if dumpBool and len(new_var_dict_list) > 0:
-                print(f"saving {var_dict_path}, add {len(new_var_dict_list)} Txs")
-                with open(f"{self.outputPath}/{var_dict_path}", "w") as f:
-                    json.dump(return_var_dict_list, f)
+                print(f"saving {store.path}, add {len(newTxDict)} Txs")
+                store.append(newTxDict)
 
         return_var_dict_list.sort(key=getVarDictBlockTx)
 
@@ -347,25 +589,23 @@ class Contract(object):
                 # var_value = None
         return var_value
     
-    def getStateVariableDtrace(self, storageMap, var_dict):
+    def getSlotPlan(self, var_dict):
+        # the mapping keys and slots of a call, shared by all the points and levels
         if self.address in self.stateVariableExtractor:
-            mappingKeys = self.stateVariableExtractor[self.address].searchKeys(var_dict)
-            return self.stateVariableExtractor[self.address].loadStateVariable(storageMap, mappingKeys)
+            return self.stateVariableExtractor[self.address].buildSlotPlan(var_dict)
+        return None
+
+    def getStateVariableDtrace(self, storageMap, slotPlan):
+        if slotPlan != None:
+            return self.stateVariableExtractor[self.address].loadStateVariableByPlan(storageMap, slotPlan)
         else:
             return dict()
 
-    def getTokenBalanceDtrace(self, tokenBalanceMap, keyAddrMap, dtraceDict):
-        for tokenAddress in tokenBalanceMap:
-            if len(tokenBalanceMap[tokenAddress]) == 0:
-                continue
-            # print(tokenBalanceMap[tokenAddress].values())
-            totalBalance = sum(tokenBalanceMap[tokenAddress].values())
-            
+    def getTokenBalanceDtrace(self, tokenMatrix, point, keyAddrMap, dtraceDict):
+        for tokenAddress in tokenMatrix.tokens[point]:
+            totalBalance = tokenMatrix.getTotal(point, tokenAddress)
             for role,addr in keyAddrMap.items():
-                if addr in tokenBalanceMap[tokenAddress]:
-                    dtraceDict[f"tokenBalance.[{tokenAddress}][{role}]"] = (tokenBalanceMap[tokenAddress][addr], 'uint')
-                else:
-                    dtraceDict[f"tokenBalance.[{tokenAddress}][{role}]"] = (0, 'uint')
+                dtraceDict[f"tokenBalance.[{tokenAddress}][{role}]"] = (tokenMatrix.getBalance(point, tokenAddress, addr), 'uint')
 
             # for user in tokenBalanceMap[tokenAddress]:
             #     if user in keyAddrMap:
@@ -423,122 +663,105 @@ class Contract(object):
                     # newDtraceDict[f'change.{var_name}'] = (postDtraceDict[var_name][0] - preDtraceDict[var_name][0], "int")
         return newDtraceDict
 
-    def extractFuncDtraceInfo(self, var_dict, level):
-        sig = var_dict['sig']
+    def getTraceBuilder(self, var_dict, slotPlan=None):
+        if slotPlan == None:
+            slotPlan = self.getSlotPlan(var_dict)
+        return TraceBuilder(self, var_dict, slotPlan)
+
+    def extractFuncDtraceInfo(self, var_dict, level, slotPlan=None, builder=None):
+        if builder == None:
+            builder = self.getTraceBuilder(var_dict, slotPlan)
+        withCall = level in ["function", "branch"]
         points = list(var_dict["points"]) if level == "branch" else ["pre","post"]
         # print(var_dict["blockNumber"], var_dict["position"])
-        pointDtraceDict = dict()
-        allTraceDict = dict()
-        # allTraceDict["tx.origin"] = (var_dict["tx.origin"], "address")
-        allTraceDict["callee"] = (var_dict["to"], "address")
-        allTraceDict["msg.sender"] = (var_dict["from"], "address")
-        allTraceDict["msg.value"] = (var_dict["value"], "uint")
-        allTraceDict["block.timestamp"] = (var_dict["timestamp"],"uint")
-        allTraceDict["block.number"] = (var_dict["blockNumber"],"uint")
-
-        # deal with method args
-        if level in ["function", "branch"]:
-            methodTraceDict = dict()
-            for argName, argContent in var_dict["args"].items():
-                if argName == "rawbytes":
-                    methodTraceDict['method.rawbytes'] = (argContent, "bytes")
-                else:
-                    var_info = self.txExtractor.functionAbi[sig]["argFormatDict"][argName]
-                    methodTraceDict[f"method.{argName}"] = self.getMethodArgDtrace(var_info['type'], var_info, argContent)
-                    # methodTraceDict.update(self.getMethodArgDtrace(f'method.{argName}', var_info['type'], var_info, argContent))
-            allTraceDict.update(self.flatDtrace(methodTraceDict))
-
-        # deal wit event
-        # when exsiting more than one event with the same name, only record the first event
-        if level in ["function", "branch"]:
-            eventTraceDict = dict()
-            for event in var_dict["events"]:
-                sig = event['sig']
-                for argName, argContent in event["args"].items():
-                    var_info = self.txExtractor.eventAbi[sig]["argFormatDict"][argName]
-                    eventTraceDict[f'event.{event["name"]}.{argName}'] = self.getMethodArgDtrace(var_info['type'], var_info, argContent)
-                    # eventTraceDict.update(self.getMethodArgDtrace(f'event.{event["name"]}.{argName}', var_info['type'], var_info, argContent))
-            allTraceDict.update(self.flatDtrace(eventTraceDict))
+        allTraceDict = dict(builder.baseTraceDict)
 
+        # deal with method args and event
+        if withCall:
+            allTraceDict.update(builder.getMethod())
+            allTraceDict.update(builder.getEvents())
 
         # deal with variables
         for point in points:
-            stateVariableDtraceDict = self.getStateVariableDtrace(var_dict["points"][point]["storage"], var_dict)
-        
-            pointDtraceDict[point] = dict()
-            varTraceDict = dict()
-            # extract traceDict from dtrace
-            if stateVariableDtraceDict != None:
-                for var_name in stateVariableDtraceDict:
-                    varTraceDict.update(self.flatDtraceUtil(f"variable.{var_name}", stateVariableDtraceDict[var_name]))
-                for var_name, var_value in varTraceDict.items():
-                    pointDtraceDict[point][var_name] = var_value
-                    allTraceDict[f"{point}({var_name})"] = var_value
-        
+            for var_name, var_value in builder.getVariables(point).items():
+                allTraceDict[f"{point}({var_name})"] = var_value
+
         flatedTraceDict = allTraceDict
-        # flatedTraceDict = self.recoverAndFlatTraceDict(allTraceDict)
         # deal with token
-        keyAddrMap = dict()
-        for var_name in flatedTraceDict:
-            if isinstance(flatedTraceDict[var_name], tuple) and isinstance(flatedTraceDict[var_name][0],str) and flatedTraceDict[var_name][1] == "address":
-                # self.addKeyAddrMap(keyAddrMap, var_name, flatedTraceDict[var_name][0])
-                # only selecting these addresses
-                if var_name.startswith("event.") or var_name.startswith("method.") or var_name.startswith("pre(variable.") or var_name in ["msg.sender", "callee", "tx.origin"]:
-                    keyAddrMap[var_name] = flatedTraceDict[var_name][0]
-        
         for point in points:
-            tokenDtraceDict = dict()
-            self.getTokenBalanceDtrace(var_dict['points'][point]['tokenBalance'], keyAddrMap, tokenDtraceDict)
-            pointDtraceDict[point].update(tokenDtraceDict)
-
-            for var_name in tokenDtraceDict:
-                flatedTraceDict[f"{point}({var_name})"] = tokenDtraceDict[var_name]
+            for var_name, var_value in builder.getTokens(point, withCall).items():
+                flatedTraceDict[f"{point}({var_name})"] = var_value
 
         # deal with change
-        for point in pointDtraceDict:
+        for point in points:
             if point != "pre":
-                changeDtraceDict = self.getChangeVarDtrace(point, pointDtraceDict[point], pointDtraceDict['pre'])
-                flatedTraceDict.update(changeDtraceDict)
-                # for var_name in changeDtraceDict:
-                #     flatedTraceDict[f"{point}({var_name})"] = changeDtraceDict[var_name]
+                flatedTraceDict.update(builder.getChanges(point, withCall))
     
         return flatedTraceDict
     
-    def fillCachedStorage(self, cachedStorage, var_dict):
+    """
+    the traceDicts of the three levels of a call, built from one TraceBuilder so the storage, tokens and changes are decoded once
+    without sub calls the branch level has the same points as the function level, and shares its traceDict
+    """
+    def extractLevelTraceDict(self, var_dict, slotPlan=None, builder=None):
+        if builder == None:
+            builder = self.getTraceBuilder(var_dict, slotPlan)
+        levelTraceDict = dict()
+        levelTraceDict["contract"] = self.extractFuncDtraceInfo(var_dict, "contract", builder=builder)
+        levelTraceDict["function"] = self.extractFuncDtraceInfo(var_dict, "function", builder=builder)
+        if list(var_dict["points"]) == ["pre","post"]:
+            levelTraceDict["branch"] = levelTraceDict["function"]
+        else:
+            levelTraceDict["branch"] = self.extractFuncDtraceInfo(var_dict, "branch", builder=builder)
+        return levelTraceDict
+
+    def overlayCachedStorage(self, storageHistory, var_dict):
+        # each point reads its own slots over the storage after the previous calls, the post storage is committed
         for point in var_dict["points"]:
-            for slot in cachedStorage:
-                if slot not in var_dict["points"][point]["storage"]:
-                    var_dict["points"][point]["storage"][slot] = cachedStorage[slot]
+            storage = var_dict["points"][point]["storage"]
+            if isinstance(storage, StorageOverlay):
+                storage = storage.storage
+            var_dict["points"][point]["storage"] = StorageOverlay(storage, storageHistory, storageHistory.version)
 
             if point == "post":
-                for slot in var_dict["points"][point]["storage"]:
-                    cachedStorage[slot] = var_dict["points"][point]["storage"][slot]
+                storageHistory.commit(storage)
     
+    def getDtrace(self, var_dict, level, traceDict):
+        if level == "contract":
+            methodString = "contract"
+        elif level == "function":
+            methodString = var_dict["name"]
+        elif level == "branch":
+            methodString = var_dict["name"] +":"+var_dict["branch"]
+        return {
+            "block_tx_index" : f"{var_dict['blockNumber']}_{var_dict['position']}_{var_dict['index']}",
+            "tx.origin": var_dict['tx.origin'],
+            "msg.sender": var_dict['from'],
+            "methodString": methodString,
+            "level":level,
+            "points": list(var_dict["points"]) if level == "branch" else ["pre","post"],
+            "traceDict": self.traceTable.makeRow(traceDict),
+        }
+
     def extractDtrace(self, var_dict_list, useCachedStorage=False):
         dtraceList = list()
-        cachedStorage = dict()
+        storageHistory = StorageHistory()
         for var_dict in var_dict_list:
             if useCachedStorage:
-                self.fillCachedStorage(cachedStorage, var_dict)
-            for level in ["contract","function","branch"]:
-                traceDict = self.extractFuncDtraceInfo(var_dict, level)
-                if level == "contract":
-                    methodString = "contract"
-                elif level == "function":
-                    methodString = var_dict["name"]
-                elif level == "branch":
-                    methodString = var_dict["name"] +":"+var_dict["branch"]
-                dtraceList.append(
-                    {
-                        "block_tx_index" : f"{var_dict['blockNumber']}_{var_dict['position']}_{var_dict['index']}",
-                        "tx.origin": var_dict['tx.origin'],
-                        "msg.sender": var_dict['from'],
-                        "methodString": methodString,
-                        "level":level,
-                        "points": list(var_dict["points"]) if level == "branch" else ["pre","post"],
-                        "traceDict": traceDict,
-                    }
-                )
+                self.overlayCachedStorage(storageHistory, var_dict)
+            levelTraceDict = self.extractLevelTraceDict(var_dict, self.getSlotPlan(var_dict))
+            dtraceList.extend(self.getLevelDtraces(var_dict, levelTraceDict))
+        return dtraceList
+
+    def getLevelDtraces(self, var_dict, levelTraceDict):
+        # the dtraces of the contract, function and branch levels, the levels sharing a traceDict share its TraceRow
+        dtraceList = list()
+        rowDict = dict()
+        for level in ["contract","function","branch"]:
+            traceDict = levelTraceDict[level]
+            if id(traceDict) not in rowDict:
+                rowDict[id(traceDict)] = self.traceTable.makeRow(traceDict)
+            dtraceList.append(self.getDtrace(var_dict, level, rowDict[id(traceDict)]))
         return dtraceList
     
 # not used ------------------------- !!!
@@ -1,9 +1,18 @@
 import base64
+import hashlib
 import sha3
 from eth_abi import decode # eth-abi                  3.0.1
 import re
 import json
+from collections import OrderedDict
 from web3 import Web3
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# the fields of a call frame that are only read for the frames calling/called by the target addresses
+stateFields = ["preState", "postState", "preTokenBalance", "postTokenBalance", "branch"]
 
 def isNormalType(var_type):
     if "[]" in var_type or "mapping" in var_type or ("[" in var_type and "]" in var_type):
@@ -145,16 +154,100 @@ def convertArgsDict(argsDict, argFormatDict):
             newDict[name] = _convertArgsDict(argInfo['type'], argInfo, argsDict[name])
     return newDict
 
+"""
+compile the decoder of an indexed topic, static types are sliced from the hex string directly
+dynamic types (string, bytes) keep the topic hash, other types and bad paddings go to eth_abi
+"""
+def compileTopicDecoder(argType):
+    def abiDecode(topic):
+        args = decode([argType], bytes.fromhex(topic[2:]))
+        # only one arg
+        assert len(args) == 1, "error in parsing topics"
+        return normalizeArg(args[0])
+
+    if argType == "string" or "byte" in argType:
+        return lambda topic: topic
+    elif argType == "address":
+        def decodeAddress(topic):
+            if len(topic) == 66 and int(topic[2:26], 16) == 0:
+                return "0x" + topic[26:].lower()
+            return abiDecode(topic)
+        return decodeAddress
+    elif argType == "bool":
+        def decodeBool(topic):
+            value = int(topic, 16)
+            if len(topic) == 66 and value in (0, 1):
+                return value == 1
+            return abiDecode(topic)
+        return decodeBool
+    elif re.fullmatch(r"uint\d*", argType):
+        bits = int(argType[4:]) if len(argType) > 4 else 256
+        def decodeUint(topic):
+            value = int(topic, 16)
+            if len(topic) == 66 and value >> bits == 0:
+                return value
+            return abiDecode(topic)
+        return decodeUint
+    elif re.fullmatch(r"int\d*", argType):
+        bits = int(argType[3:]) if len(argType) > 3 else 256
+        def decodeInt(topic):
+            value = int(topic, 16)
+            if value >> 255:
+                value -= 1 << 256
+            if len(topic) == 66 and -(1 << (bits - 1)) <= value < (1 << (bits - 1)):
+                return value
+            return abiDecode(topic)
+        return decodeInt
+    return abiDecode
+
+"""
+build the value from ijson events, starting at (event, value)
+"""
+def buildJsonValue(events, event, value):
+    if event == "start_map":
+        obj = dict()
+        for event, value in events:
+            if event == "end_map":
+                return obj
+            key = value
+            event, value = next(events)
+            obj[key] = buildJsonValue(events, event, value)
+    elif event == "start_array":
+        arr = list()
+        for event, value in events:
+            if event == "end_array":
+                return arr
+            arr.append(buildJsonValue(events, event, value))
+    else:
+        return value
+
+def skipJsonValue(events, event):
+    if event != "start_map" and event != "start_array":
+        return
+    depth = 1
+    for event, _ in events:
+        if event == "start_map" or event == "start_array":
+            depth += 1
+        elif event == "end_map" or event == "end_array":
+            depth -= 1
+            if depth == 0:
+                return
+
 def genBranch(jumpList):
     branchString = "-".join([f"{x['pc']}-{x['destination']}" for x in jumpList])
     return branchString
 
 class TxExtractor(object):
 
-    def __init__(self, addrs, abiList):
+    def __init__(self, addrs, abiList, decodeCacheSize=4096):
         self.addresses = addrs
         self.functionAbi = dict()
         self.eventAbi = dict()
+        # map topic0 => compiled event decoder
+        self.eventDecoders = dict()
+        # LRU cache of converted args, map (sig, hash of calldata) => args
+        self.decodeCache = OrderedDict()
+        self.decodeCacheSize = decodeCacheSize
         
         self.initABI(abiList)
 
@@ -188,6 +281,14 @@ class TxExtractor(object):
                         argInfoDict["dataArgNames"] = dataArgNames
                         argInfoDict['topicFormats'] = topicFormat
                         self.eventAbi[sig] = argInfoDict
+                        self.eventDecoders["0x" + sig] = {
+                            "name": argInfoDict["methodString"].split('(')[0],
+                            "sig": sig,
+                            "topicDecoders": [(x["name"], compileTopicDecoder(x["type"])) for x in topicFormat],
+                            "dataTypes": dataArgFromatForDecode,
+                            "dataArgNames": dataArgNames,
+                            "argFormatDict": argInfoDict["argFormatDict"],
+                        }
                     else:
                         print(method)
                     # print(sig, argInfoDict["methodString"])
@@ -195,6 +296,56 @@ class TxExtractor(object):
         # only for decode function input
         self.contract = w3.eth.contract(address="0x0000000000000000000000000000000000000000", abi=[x["abi"] for x in self.functionAbi.values()])
 
+    def loadExTx(self, txPath):
+        if ijson == None:
+            with open(txPath, "r") as f:
+                return json.load(f)
+        # walk the call tree while parsing, the state of unrelated frames is never built
+        with open(txPath, "rb") as f:
+            events = ijson.basic_parse(f)
+            event, value = next(events)
+            assert event == "start_map", f"unknown tx format {txPath}"
+            transaction = dict()
+            for event, value in events:
+                if event == "end_map":
+                    break
+                key = value
+                event, value = next(events)
+                if key == "call" and event == "start_map":
+                    transaction[key] = self.loadCallFrame(events)
+                else:
+                    transaction[key] = buildJsonValue(events, event, value)
+        return transaction
+
+    def isStateFrame(self, frame):
+        # the same condition as extractcall for recording the state of a call
+        # the go backend writes type/from/to before the state fields, otherwise keep the state
+        if "type" not in frame or "from" not in frame or "to" not in frame:
+            return True
+        return frame["type"] in ["CALL", "CREATE"] and (frame["to"] in self.addresses or frame["from"] in self.addresses)
+
+    def loadCallFrame(self, events):
+        frame = dict()
+        for event, value in events:
+            if event == "end_map":
+                break
+            key = value
+            event, value = next(events)
+            if key == "calls" and event == "start_array":
+                frame[key] = list()
+                for event, value in events:
+                    if event == "end_array":
+                        break
+                    if event == "start_map":
+                        frame[key].append(self.loadCallFrame(events))
+                    else:
+                        frame[key].append(buildJsonValue(events, event, value))
+            elif key in stateFields and not self.isStateFrame(frame):
+                skipJsonValue(events, event)
+            else:
+                frame[key] = buildJsonValue(events, event, value)
+        return frame
+
     def extractExTx(self, transaction, excludePartialErr=False):
         callList = list()
         # print(transaction["blockNumber"], transaction["position"])
@@ -222,26 +373,15 @@ class TxExtractor(object):
             "args" : list(),
         }
         if call["to"] in self.addresses and call["type"] in ["CALL","CREATE"] and call["input"] != None:
-            sig = base64.b64decode(call["input"]).hex()[:8]
+            inputBytes = base64.b64decode(call["input"])
+            sig = inputBytes[:4].hex()
             # print(self.defi_info["abi"])
             if sig in self.functionAbi:
                 if self.functionAbi[sig]["stateMutability"] != "view":
                     isTargetFunction = True
                     tmpCall["sig"] = sig
                     tmpCall["name"] = self.functionAbi[sig]["methodString"]
-                    # deal with the case when len(call["input"][4:]%32) != 0, fill 00 to fix
-                    tmpInput = base64.b64decode(call["input"]).hex()
-                    try:
-                        _, argsDict = self.contract.decode_function_input(tmpInput)
-                        tmpCall["args"] = convertArgsDict(argsDict, self.functionAbi[sig]["argFormatDict"])
-                    except:
-                        # print(self.functionAbi[sig]["methodString"], tmpInput)
-                        # if len(tmpInput[8:]) % 64 != 0:
-                        #     tmpInput = tmpInput + "0" * (64 - len(tmpInput[8:]) % 64)
-                        # _, argsDict = self.contract.decode_function_input(tmpInput)
-                        tmpCall['args'] = {
-                            "rawbytes": "0x" + base64.b64decode(call["input"]).hex()[8:]
-                        }
+                    tmpCall["args"] = self.decodeFunctionInput(sig, inputBytes)
             else:
                 # print(sig)
                 # assert False, "error in extractTxs"
@@ -250,7 +390,7 @@ class TxExtractor(object):
                     tmpCall["name"] = sig
                     tmpCall['sig'] = sig
                     tmpCall['args'] = {
-                        "rawbytes": "0x" + base64.b64decode(call["input"]).hex()[8:]
+                        "rawbytes": "0x" + inputBytes[4:].hex()
                     }
                 elif call["type"] == "CREATE":
                     tmpCall["name"] = "constructor"
@@ -299,40 +439,48 @@ class TxExtractor(object):
             return eventList, tmpCallList, False
         
 
+    def decodeFunctionInput(self, sig, inputBytes):
+        # bots and keepers send the same calldata again and again
+        # the cached args are shared by these calls, they are only read afterwards
+        key = (sig, hashlib.blake2b(inputBytes, digest_size=16).digest())
+        if key in self.decodeCache:
+            self.decodeCache.move_to_end(key)
+            return self.decodeCache[key]
+
+        # deal with the case when len(call["input"][4:]%32) != 0, fill 00 to fix
+        try:
+            _, argsDict = self.contract.decode_function_input(inputBytes.hex())
+            args = convertArgsDict(argsDict, self.functionAbi[sig]["argFormatDict"])
+        except:
+            args = {
+                "rawbytes": "0x" + inputBytes[4:].hex()
+            }
+        self.decodeCache[key] = args
+        if len(self.decodeCache) > self.decodeCacheSize:
+            self.decodeCache.popitem(last=False)
+        return args
+
     def extractEvent(self, event):
-        sig = event["topics"][0][2:]
-        if sig in self.eventAbi and event["address"] in self.addresses:
+        decoder = self.eventDecoders.get(event["topics"][0])
+        if decoder != None and event["address"] in self.addresses:
             # deal with topics
             tmpEvent = {
-                "name": self.eventAbi[sig]["methodString"].split('(')[0],
+                "name": decoder["name"],
                 "address": event["address"],
-                "sig": sig,
+                "sig": decoder["sig"],
             }
             argsDict = dict()
-            # print(self.eventAbi[sig]["methodString"], self.eventAbi[sig]["topicFormats"])
-            # for i, topic in enumerate(event["Topics"][1:]):
-            for i, topicFormat in enumerate(self.eventAbi[sig]["topicFormats"]):
-                topic = event["topics"][1:][i]
-                if topicFormat["type"] == "string":
-                    args = [topic]
-                elif "byte" in topicFormat["type"]:
-                    args = [topic]
-                else:
-                    argFormat = [topicFormat["type"]]
-                    args = decode(argFormat, bytes.fromhex(topic[2:]))
-                # only one arg
-                assert len(args) == 1, "error in parsing topics"
-                argsDict[topicFormat["name"]] = normalizeArg(args[0])
+            topics = event["topics"]
+            for i, (name, decodeTopic) in enumerate(decoder["topicDecoders"]):
+                argsDict[name] = decodeTopic(topics[i + 1])
 
             # deal with data
             if event["data"]:
-                argFormatForDecode = self.eventAbi[sig]["dataArgFromatForDecode"]
-                args = decode(argFormatForDecode, bytes.fromhex(base64.b64decode(event["data"]).hex()))
+                args = decode(decoder["dataTypes"], base64.b64decode(event["data"]))
                 for index, arg in enumerate(args):
-                    argsDict[self.eventAbi[sig]['dataArgNames'][index]] = arg
+                    argsDict[decoder['dataArgNames'][index]] = arg
 
-            # print(self.eventAbi[sig]["argFormatDict"], argsDict)
-            tmpEvent["args"] = convertArgsDict(argsDict, self.eventAbi[sig]["argFormatDict"])
+            tmpEvent["args"] = convertArgsDict(argsDict, decoder["argFormatDict"])
             return tmpEvent
         return None
 
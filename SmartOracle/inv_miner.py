@@ -1,6 +1,8 @@
 from contract import *
 from patterns import *
 import re
+import sys
+from multiprocessing import get_context
 
 # compare the user-supplied data and contract status
 # 1 - tokenBalance
@@ -34,13 +36,7 @@ def splitPointAndVariable(var_name):
         return new_var_name, var_name.split("(")[0]
     return var_name, None
 
-def isComparable(var_name, compared_var_name):
-    var_name, var_name_point = splitPointAndVariable(var_name)
-    compared_var_name, compared_var_name_point = splitPointAndVariable(compared_var_name)
-
-    comparability = getComparability(var_name)
-    compared_comparability = getComparability(compared_var_name)
-
+def compareComparability(comparability, var_name_point, compared_comparability, compared_var_name_point):
     # if var_name_point == "pre" and compared_var_name == "pre":
     #     # do not compare in pre
     #     return False
@@ -76,6 +72,189 @@ def getComparability(var_name):
         else:
             return ComparabilityDict[var_type]
 
+# the relations that CandidateSet checks on encoded value columns, the others run their compiled inv
+CandidateKinds = {
+    EqualRelation: 1,
+    OppositeRelation: 2,
+}
+
+"""
+the live relations of a methodString once incrementalAlg stops searching, in the order of relationDict
+nums counts the traces each relation satisfies and live marks the relations that are not pruned yet
+the traces are queued and checked in batches: the values of a batch are encoded per variable,
+so the Equal/Opposite relations are checked at once by comparing code columns, the membership and inference ones trace by trace
+count - num never decreases, so a relation is pruned at the end of a batch exactly when it would have been pruned within it
+"""
+class CandidateSet(object):
+
+    def __init__(self, invDict, compileInv):
+        self.invs = list(invDict)
+        self.infos = [invDict[inv] for inv in self.invs]
+        self.evaluates = [compileInv(invInfo) for invInfo in self.infos]
+        self.nums = np.array([invInfo["num"] for invInfo in self.infos], dtype=np.int64)
+        self.live = np.ones(len(self.invs), dtype=bool)
+        self.pending = list() # [(count, getVar)]
+
+        self.varNames = list()
+        varIndex = dict() # map var_name => row of the code matrices
+        self.kinds = np.zeros(len(self.invs), dtype=np.int8)
+        self.xIds = np.full(len(self.invs), -1, dtype=np.int64)
+        self.yIds = np.full(len(self.invs), -1, dtype=np.int64)
+        for index, invInfo in enumerate(self.infos):
+            model = invInfo.get("model")
+            if invInfo["type"] != "normal" or type(model) not in CandidateKinds:
+                continue
+            self.kinds[index] = CandidateKinds[type(model)]
+            for var_name in [model.x_name, model.y_name]:
+                if var_name not in varIndex:
+                    varIndex[var_name] = len(self.varNames)
+                    self.varNames.append(var_name)
+            self.xIds[index] = varIndex[model.x_name]
+            self.yIds[index] = varIndex[model.y_name]
+
+    def addTrace(self, count, getVar):
+        self.pending.append((count, getVar))
+
+    def encodeBatch(self, varIds):
+        # code matrices of the pending traces, -1 for the cells no relation can satisfy
+        # strict: the same code for the values of the same type that are ==, for EqualRelation
+        # ints/negInts: the code of an int and of its negation, for OppositeRelation
+        shape = (len(self.varNames), len(self.pending))
+        strict = np.full(shape, -1, dtype=np.int64)
+        ints = np.full(shape, -1, dtype=np.int64)
+        negInts = np.full(shape, -1, dtype=np.int64)
+        strictCodes, intCodes = dict(), dict()
+        intCells = list()
+        slowVars = set() # the vars with unhashable values, their relations are evaluated
+        for varId in varIds:
+            var_name = self.varNames[varId]
+            for column, (count, getVar) in enumerate(self.pending):
+                var_value = getVar(var_name)
+                if isinstance(var_value, list) or isinstance(var_value, dict):
+                    continue
+                if type(var_value) == str and var_value == "nonsensical":
+                    continue
+                try:
+                    strict[varId, column] = strictCodes.setdefault((type(var_value), var_value), len(strictCodes))
+                except TypeError:
+                    slowVars.add(varId)
+                    continue
+                if type(var_value) == int:
+                    ints[varId, column] = intCodes.setdefault(var_value, len(intCodes))
+                    intCells.append((varId, column, var_value))
+        for varId, column, var_value in intCells:
+            negInts[varId, column] = intCodes.get(-var_value, -1)
+        return strict, ints, negInts, slowVars
+
+    def flush(self, threshold_bar):
+        if len(self.pending) == 0:
+            return
+        liveIndex = np.flatnonzero(self.live)
+        satisfied = np.zeros((len(self.invs), len(self.pending)), dtype=bool)
+
+        grouped = liveIndex[self.kinds[liveIndex] > 0]
+        varIds = np.unique(np.concatenate((self.xIds[grouped], self.yIds[grouped])))
+        strict, ints, negInts, slowVars = self.encodeBatch(varIds[varIds >= 0])
+        if len(slowVars) > 0:
+            slow = np.isin(self.xIds[grouped], list(slowVars)) | np.isin(self.yIds[grouped], list(slowVars))
+            grouped = grouped[~slow]
+
+        index = grouped[self.kinds[grouped] == CandidateKinds[EqualRelation]]
+        xCodes = strict[self.xIds[index]]
+        satisfied[index] = (xCodes == strict[self.yIds[index]]) & (xCodes >= 0)
+
+        index = grouped[self.kinds[grouped] == CandidateKinds[OppositeRelation]]
+        xCodes = ints[self.xIds[index]]
+        satisfied[index] = (xCodes == negInts[self.yIds[index]]) & (xCodes >= 0)
+
+        # the other relations (membership, inference) and the ones over unhashable values
+        evaluated = np.setdiff1d(liveIndex, grouped)
+        for position in evaluated:
+            evaluate = self.evaluates[position]
+            for column, (count, getVar) in enumerate(self.pending):
+                satisfied[position, column] = evaluate(getVar) == "satisfy"
+
+        self.nums[liveIndex] += satisfied[liveIndex].sum(axis=1)
+        # remove the relations that could not satisfy threshold
+        lastCount = self.pending[-1][0]
+        self.live &= lastCount - self.nums <= threshold_bar
+        self.pending = list()
+
+        if not self.live.all():
+            keep = np.flatnonzero(self.live)
+            self.invs = [self.invs[position] for position in keep]
+            self.infos = [self.infos[position] for position in keep]
+            self.evaluates = [self.evaluates[position] for position in keep]
+            self.kinds = self.kinds[keep]
+            self.xIds = self.xIds[keep]
+            self.yIds = self.yIds[keep]
+            self.nums = self.nums[keep]
+            self.live = np.ones(len(keep), dtype=bool)
+
+    def toInvDict(self):
+        invDict = dict()
+        for inv, invInfo, num in zip(self.invs, self.infos, self.nums):
+            invInfo["num"] = int(num)
+            invDict[inv] = invInfo
+        return invDict
+
+"""
+the int variables of the traces of a methodString, one row per trace and one column per var_name in the order first seen
+values is an object matrix (uint256 does not fit int64), usable marks the cells that are in the trace and not 0,
+the cells of a column before it is first seen are the "nonsensical" of the padded lists
+"""
+class IntColumns(object):
+
+    def __init__(self):
+        self.names = list()
+        self.index = dict() # map var_name => column
+        self.rows = list() # [(columns, values)] of each trace
+        self.matrix = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def addRow(self, tmpIntDict):
+        columns = list()
+        for var_name in tmpIntDict:
+            if var_name not in self.index:
+                self.index[var_name] = len(self.names)
+                self.names.append(var_name)
+            columns.append(self.index[var_name])
+        self.rows.append((columns, list(tmpIntDict.values())))
+        self.matrix = None
+
+    def getMatrix(self):
+        # (values, usable), built once after the rows are collected
+        if self.matrix == None:
+            values = np.zeros((len(self.rows), len(self.names)), dtype=object)
+            usable = np.zeros((len(self.rows), len(self.names)), dtype=bool)
+            for row, (columns, var_values) in enumerate(self.rows):
+                values[row, columns] = var_values
+                usable[row, columns] = [var_value != 0 for var_value in var_values]
+            self.matrix = (values, usable)
+        return self.matrix
+
+    def getPairCounts(self):
+        # number of rows that both columns are usable
+        _, usable = self.getMatrix()
+        usable = usable.astype(np.int64)
+        return usable.T @ usable
+
+# for parallel mining, each worker process mines methodStrings with the forked hunter
+_mineHunter = None
+_mineArgs = None
+
+def _initMineWorker(hunter, methodDtraceDict, threshold, batchSize):
+    global _mineHunter, _mineArgs
+    _mineHunter = hunter
+    _mineArgs = (methodDtraceDict, threshold, batchSize)
+
+def _mineMethodString(methodString):
+    methodDtraceDict, threshold, batchSize = _mineArgs
+    dtraceList = methodDtraceDict[methodString]
+    return _mineHunter.mineMethodString(methodString, dtraceList, len(dtraceList), threshold=threshold, batchSize=batchSize)
+
 class InvHunter(object):
     
     def __init__(self, contract) -> None:
@@ -84,6 +263,15 @@ class InvHunter(object):
         self.invDict = dict()
         self.invDictPerTx = dict()
         self.keyInvDict = dict()
+        # map methodString => (invDict, len(invDict), [(inv, evaluate)]), compiled from keyInvDict for checking
+        self.checkPlans = dict()
+        # map var_name => class id, a class is the (point, comparability) that compareComparability depends on
+        self.varCatalogue = dict()
+        # map (point, comparability) => class id, and class id => (point, comparability)
+        self.varClasses = dict()
+        self.varClassList = list()
+        # map (class id, compared class id) => comparable, bounded by the classes rather than the names
+        self.comparableClasses = dict()
 
         self.tracesDict = dict()
 
@@ -116,8 +304,9 @@ class InvHunter(object):
             json.dump(self.invDictPerTx, f)
 
     def dumpTrace(self, dtraceList, outputPath):
+        # {"symbols": [var_name], "types": [type], "dtraces": [dtrace]}, each traceDict is dumped as [ids, values, typeCodes]
         with open(outputPath, "w") as f:
-            json.dump(dtraceList, f)
+            json.dump(self.contract.traceTable.dump(dtraceList), f)
 
     def dumpInvDict(self, outputPath):
         dumpedInvDict = dict()
@@ -141,10 +330,32 @@ class InvHunter(object):
                 relation_dict[str(temp_inv)] = temp_inv
         return relation_dict
 
+    def getVarClass(self, var_name):
+        if var_name not in self.varCatalogue:
+            base_name, point = splitPointAndVariable(var_name)
+            varClass = (point, getComparability(base_name))
+            if varClass not in self.varClasses:
+                self.varClasses[varClass] = len(self.varClassList)
+                self.varClassList.append(varClass)
+            self.varCatalogue[sys.intern(var_name)] = self.varClasses[varClass]
+        return self.varCatalogue[var_name]
+
+    """
+    each name is classified once into the class id of its (point, comparability),
+    compareComparability runs once per pair of classes, the names of all methodStrings share the answers
+    """
+    def isComparablePair(self, var_name, compared_var_name):
+        classPair = (self.getVarClass(var_name), self.getVarClass(compared_var_name))
+        if classPair not in self.comparableClasses:
+            var_name_point, comparability = self.varClassList[classPair[0]]
+            compared_var_name_point, compared_comparability = self.varClassList[classPair[1]]
+            self.comparableClasses[classPair] = compareComparability(comparability, var_name_point, compared_comparability, compared_var_name_point)
+        return self.comparableClasses[classPair]
+
     def mineVar(self, var_name, compared_var_name, traceDict):
         relation_dict = dict()
         # do not deal with some cases
-        if isComparable(var_name, compared_var_name):
+        if self.isComparablePair(var_name, compared_var_name):
             # if isinstance(traceDict[var_name], tuple) and isinstance(traceDict[compared_var_name], tuple):
             if traceDict[var_name][1] not in ['array','mapping'] and traceDict[compared_var_name][1] not in ['array','mapping']:
                 var_type = traceDict[var_name][1]
@@ -197,32 +408,32 @@ class InvHunter(object):
 
     def mineMethodModel(self, methodIntDict, low_threshold):
         model_dict = dict()
-        for var_name in methodIntDict["vars"]:
-            assert len(methodIntDict["vars"][var_name]) == methodIntDict["count"], f'unmatched intDict {len(methodIntDict["vars"][var_name])} != {methodIntDict["count"]}'
-
-        for x_name, xList in methodIntDict["vars"].items():
-            if len(xList) < low_threshold:
-                continue
-            for y_name, yList in methodIntDict["vars"].items():
-                if x_name == y_name:
+        intColumns = methodIntDict["vars"]
+        if methodIntDict["count"] < low_threshold or len(intColumns.names) == 0:
+            return model_dict
+
+        values, usable = intColumns.getMatrix()
+        # screen the (x, y) pairs by the number of usable rows they share
+        pairCounts = intColumns.getPairCounts()
+        for x, x_name in enumerate(intColumns.names):
+            for y in np.flatnonzero(pairCounts[x] > low_threshold):
+                if x == y:
                     continue
-                x_y_list = []
-                for index, x in enumerate(xList):
-                    if x != "nonsensical" and x != 0 and yList[index] != "nonsensical" and yList[index] != 0:
-                        x_y_list.append([x, yList[index]])
-                if len(x_y_list) > low_threshold:
-                    # print(x_name, y_name, type(xList[0]), type(yList[0]))
-                    # print(len(x_y_list), len(xList), len(yList))
-                    for ModelRelation in modelRelationWithTwoVarList:
-                        try:
-                            modelRelation = ModelRelation(x_name, y_name)
-                            flag = modelRelation.constructRelation(x_y_list)
-                            if flag:
-                                model_dict[str(modelRelation)] = modelRelation
-                                # model_dict[methodString][str(modelRelation)]["type"] = "model"
-                                # model_dict[methodString][str(modelRelation)]["model"] = modelRelation
-                        except:
-                            pass
+                y_name = intColumns.names[y]
+                rows = np.flatnonzero(usable[:, x] & usable[:, y])
+                x_y_list = [[values[row, x], values[row, y]] for row in rows]
+                # print(x_name, y_name, type(xList[0]), type(yList[0]))
+                # print(len(x_y_list), len(xList), len(yList))
+                for ModelRelation in modelRelationWithTwoVarList:
+                    try:
+                        modelRelation = ModelRelation(x_name, y_name)
+                        flag = modelRelation.constructRelation(x_y_list)
+                        if flag:
+                            model_dict[str(modelRelation)] = modelRelation
+                            # model_dict[methodString][str(modelRelation)]["type"] = "model"
+                            # model_dict[methodString][str(modelRelation)]["model"] = modelRelation
+                    except:
+                        pass
                 # deal with three items
                 # for z_name, zList in intDict[methodString]["vars"].items():
                 #     x_y_z_list = []
@@ -280,32 +491,42 @@ class InvHunter(object):
         
     #     return essentialDtrace
         
+    """
+    a relation is inferred from inv and var_name only if the string value of var_name occurs in a variable of inv,
+    so the string values are indexed once and each relation only visits the variables whose value it contains
+    the rounds are kept, the first relation inferred for a string wins and the later rounds build on it
+    """
     def inferInvs(self, normal_relation_dict, traceDict):
         new_relation_dict = normal_relation_dict
+
+        valueIndex = dict() # map string value => [(position, var_name)], in the order of traceDict
+        for position, (var_name, var_value) in enumerate(traceDict.items()):
+            if isinstance(var_value, tuple) and type(var_value[0]) == str:
+                var_value = var_value[0]
+                if len(var_value) > 2:
+                    if var_value not in valueIndex:
+                        valueIndex[var_value] = list()
+                    valueIndex[var_value].append((position, var_name))
+
+        nameValues = dict() # map variable name of relations => the values occurring in it
         oldRelation = set(list(normal_relation_dict.keys()))
-        
-        while True:
+        while len(oldRelation) > 0:
             newRelation = set()
             for inv in oldRelation:
-                for var_name, var_value in traceDict.items():
-                    if isinstance(var_value, tuple) and type(var_value[0]) == str:
-                        var_value = var_value[0]
-                        if len(var_value) > 2:
-                            inferenceRelation = InferenceRelation(new_relation_dict[inv], var_name)
-                            flag = inferenceRelation.constructRelation(var_value)
-                            if flag:
-                                if str(inferenceRelation) not in new_relation_dict:
-                                    new_relation_dict[str(inferenceRelation)] = inferenceRelation
-                                    newRelation.add(str(inferenceRelation))
-            if len(newRelation) == 0:
-                break
-            else:
-                oldRelation = newRelation
-                # for relation in newRelation:
-                #     print(relation)
-                #     print(new_relation_dict[relation], new_relation_dict[relation].x_replaceFormat, new_relation_dict[relation].y_replaceFormat)
-                # print("----------------------------")
-                            
+                candidates = set()
+                for name in new_relation_dict[inv].getVars():
+                    if name not in nameValues:
+                        nameValues[name] = [var_value for var_value in valueIndex if var_value in name]
+                    for var_value in nameValues[name]:
+                        candidates.update((position, var_name, var_value) for position, var_name in valueIndex[var_value])
+                for _, var_name, var_value in sorted(candidates):
+                    inferenceRelation = InferenceRelation(new_relation_dict[inv], var_name)
+                    flag = inferenceRelation.constructRelation(var_value)
+                    if flag:
+                        if str(inferenceRelation) not in new_relation_dict:
+                            new_relation_dict[str(inferenceRelation)] = inferenceRelation
+                            newRelation.add(str(inferenceRelation))
+            oldRelation = newRelation
 
         # new_relation_dict = dict()
         # for inv in normal_relation_dict:
@@ -359,17 +580,65 @@ class InvHunter(object):
                     keyInvDict[methodString][inv] = invInfo
         return keyInvDict
     
+    """
+    the pairs (index, compared_index) of var_name_list that mineVar may find relations for, in the order of the nested loop
+    Equal needs the same type and value, Opposite needs int values v and -v, so the scalars are bucketed by value
+    the arrays, bytes and the values that cannot be bucketed are paired with every variable
+    """
+    def getCandidatePairs(self, var_name_list, traceDict):
+        valueBuckets = dict() # map (type, value) => [index]
+        intBuckets = dict() # map int value => [index]
+        bruteIndexes = list()
+        for index, var_name in enumerate(var_name_list):
+            var_value, var_type = traceDict[var_name][0], traceDict[var_name][1]
+            if var_type in ['array','mapping'] or var_type[:5] == "bytes":
+                bruteIndexes.append(index)
+                continue
+            if var_type == "address":
+                if type(var_value) != str:
+                    bruteIndexes.append(index)
+                    continue
+                var_value = var_value.lower()
+            try:
+                key = (type(var_value), var_value)
+                hash(key)
+            except TypeError:
+                bruteIndexes.append(index)
+                continue
+            if var_value == 0:
+                continue
+            if key not in valueBuckets:
+                valueBuckets[key] = list()
+            valueBuckets[key].append(index)
+            if type(var_value) == int:
+                if var_value not in intBuckets:
+                    intBuckets[var_value] = list()
+                intBuckets[var_value].append(index)
+
+        pairs = set()
+        for indexes in valueBuckets.values():
+            for i, index in enumerate(indexes):
+                for compared_index in indexes[i + 1:]:
+                    pairs.add((index, compared_index))
+        for var_value, indexes in intBuckets.items():
+            if var_value > 0 and -var_value in intBuckets:
+                for index in indexes:
+                    for compared_index in intBuckets[-var_value]:
+                        pairs.add((min(index, compared_index), max(index, compared_index)))
+        for index in bruteIndexes:
+            for compared_index in range(len(var_name_list)):
+                if compared_index != index:
+                    pairs.add((min(index, compared_index), max(index, compared_index)))
+        return sorted(pairs)
+
     def searchInvs(self, methodString, traceDict, relationDict):
 
         # extract normal relaation
         normal_relation_dict = dict() # map str(relation) => relation
         var_name_list = list(traceDict.keys())
-        for index, var_name in enumerate(var_name_list):
+        for index, compared_index in self.getCandidatePairs(var_name_list, traceDict):
             # normal_relation_dict.update(self.mineSingleVar(var_name=var_name, traceDict=traceDict))
-            for compared_var_name in var_name_list[index + 1:]:
-                # if methodString == "transfer(address,uint256)":
-                #     print(var_name, compared_var_name)
-                normal_relation_dict.update(self.mineVar(var_name, compared_var_name, traceDict))
+            normal_relation_dict.update(self.mineVar(var_name_list[index], var_name_list[compared_index], traceDict))
 
         # for relation in normal_relation_dict:
         #     if relation not in relationDict[methodString]["invs"]:
@@ -389,109 +658,131 @@ class InvHunter(object):
                 relationDict[methodString]["invs"][relation]["model"] = all_relation_dict[relation]
             relationDict[methodString]["invs"][relation]["num"] += 1
 
-    def incrementalAlg(self, allDtraceList, threshold=1, lowBar=3, max_methodCount=100):
-        # allDtraceList = self.contract.extractDtrace(self.contract.var_dict_list)
-        print("extract invs from benign, length of dtraceList", len(allDtraceList))
-
-        methodAllCountDict = dict()
+    """
+    mine the traces of one methodString, in the order of allDtraceList
+    returns (relationDict[methodString], intDict[methodString], the arithmetic models), no state is shared with the other methodStrings
+    the int columns are only used for the models, intDict[methodString] keeps the count and the var_names
+    """
+    def mineMethodString(self, methodString, dtraceList, methodNum, threshold=1, batchSize=256):
         relationDict = dict()
+        relationDict[methodString] = dict()
+        relationDict[methodString]["count"] = 0
+        relationDict[methodString]["invs"] = dict()
 
-        for dtrace in allDtraceList:
-            methodString = dtrace["methodString"]
-            if dtrace["methodString"] not in methodAllCountDict:
-                methodAllCountDict[methodString] = dict()
-                methodAllCountDict[methodString]["num"] = 0
-                methodAllCountDict[methodString]["traces"] = dict()
-            methodAllCountDict[methodString]['num'] += 1
-            for var_name in dtrace["traceDict"]:
-                if var_name not in methodAllCountDict[methodString]["traces"]:
-                    methodAllCountDict[methodString]["traces"][var_name] = 0
-                methodAllCountDict[methodString]["traces"][var_name] += 1
-
-            if methodString not in relationDict:
-                relationDict[methodString] = dict()
-                relationDict[methodString]["count"] = 0
-                relationDict[methodString]["invs"] = dict()
-
-        # removeTraces = dict()
-        # for methodString in methodAllCountDict:
-        #     removeTraces[methodString] = set()
-        #     for trace in methodAllCountDict[methodString]["traces"]:
-        #         if methodAllCountDict[methodString]["traces"][trace] < methodAllCountDict[methodString]["num"] * threshold:
-        #             removeTraces[methodString].add(trace)
+        methodIntDict = dict()
+        methodIntDict["count"] = 0
+        methodIntDict["vars"] = IntColumns()
 
-        intDict = dict()
-        for dtrace in allDtraceList:
-            methodString = dtrace["methodString"]
+        threshold_bar = methodNum * (1-threshold)
+        candidateSet = None # after searching
+        for dtrace in dtraceList:
             traceDict = dtrace["traceDict"]
-            points = dtrace["points"]
             # print(dtrace["block_tx_index"])
-            # init each methodString
 
             # remove some traces
             # for trace in removeTraces[methodString]:
             #     if trace in traceDict:
             #         traceDict.pop(trace)
 
-            # start: for collecting int variables
-            if methodString not in intDict:
-                intDict[methodString] = dict()
-                intDict[methodString]["count"] = 0
-                intDict[methodString]["vars"] = dict()
-            
             # if relationDict[methodString]["count"] > max_methodCount:
             #     continue
 
+            # start: for collecting int variables
             tmpIntDict = dict()
             for var_name in traceDict:
                 if isinstance(traceDict[var_name], tuple):
                     var_value = traceDict[var_name][0]
                     if type(var_value) == int:
                         # collect int var
-                        if var_name not in intDict[methodString]["vars"]:
-                            intDict[methodString]["vars"][var_name] = ["nonsensical"] * intDict[methodString]["count"]
                         tmpIntDict[var_name] = var_value
 
-            for var_name in intDict[methodString]["vars"]:
-                if var_name in tmpIntDict:
-                    intDict[methodString]["vars"][var_name].append(tmpIntDict[var_name])
-                else:
-                    intDict[methodString]["vars"][var_name].append("nonsensical")
-
-            intDict[methodString]["count"] += 1
+            methodIntDict["vars"].addRow(tmpIntDict)
+            methodIntDict["count"] += 1
             # end: for collecting int variables
 
             # start: for mining invariants
-            threshold_bar = methodAllCountDict[methodString]["num"] * (1-threshold)
             if relationDict[methodString]["count"] == 0:
                 # for initilizing
                 relationDict[methodString]["count"] += 1
                 self.searchInvs(methodString, traceDict, relationDict)
             else:
                 relationDict[methodString]["count"] += 1
-                removeRelation = set()
                 if relationDict[methodString]["count"] <= threshold_bar:
                     # perform searching
                     self.searchInvs(methodString, traceDict, relationDict)
                 elif relationDict[methodString]["count"] > threshold_bar:
-                    # perform incremental alg
-                    for relation in relationDict[methodString]["invs"]:
-                        res = self.checkInv(relation, relationDict[methodString]["invs"][relation], traceDict)
-                        if res == "satisfy":
-                            relationDict[methodString]["invs"][relation]["num"] += 1
-                        # for increasing efficiency
-                        if relationDict[methodString]["count"] - relationDict[methodString]["invs"][relation]["num"] > threshold_bar:
-                            removeRelation.add(relation)
-
-                # remove the relations that could not satisfy threshold
-                for relation in removeRelation:
-                    del relationDict[methodString]["invs"][relation]
+                    # perform incremental alg, no relation is added to methodString from now on
+                    if candidateSet == None:
+                        candidateSet = CandidateSet(relationDict[methodString]["invs"], self.compileInv)
+                    candidateSet.addTrace(relationDict[methodString]["count"], self.getTraceVarGetter(traceDict))
+                    if len(candidateSet.pending) >= batchSize:
+                        candidateSet.flush(threshold_bar)
+
+        if candidateSet != None:
+            candidateSet.flush(threshold_bar)
+            relationDict[methodString]["invs"] = candidateSet.toInvDict()
+
+        modelInvDict = self.mineMethodModel(methodIntDict, methodNum * threshold)
+        # do not send the rows and matrices back from a worker
+        methodIntDict["vars"] = methodIntDict["vars"].names
+        return relationDict[methodString], methodIntDict, modelInvDict
+
+    """
+    processNum > 1 mines the methodStrings in a process pool, the results are merged in the order of the methodStrings in allDtraceList
+    """
+    def incrementalAlg(self, allDtraceList, threshold=1, lowBar=3, max_methodCount=100, batchSize=256, processNum=1):
+        # allDtraceList = self.contract.extractDtrace(self.contract.var_dict_list)
+        print("extract invs from benign, length of dtraceList", len(allDtraceList))
+
+        methodAllCountDict = dict()
+        methodDtraceDict = dict() # map methodString => [dtrace]
+
+        for dtrace in allDtraceList:
+            methodString = dtrace["methodString"]
+            if dtrace["methodString"] not in methodAllCountDict:
+                methodAllCountDict[methodString] = dict()
+                methodAllCountDict[methodString]["num"] = 0
+                methodAllCountDict[methodString]["traces"] = dict()
+                methodDtraceDict[methodString] = list()
+            methodAllCountDict[methodString]['num'] += 1
+            for var_name in dtrace["traceDict"]:
+                if var_name not in methodAllCountDict[methodString]["traces"]:
+                    methodAllCountDict[methodString]["traces"][var_name] = 0
+                methodAllCountDict[methodString]["traces"][var_name] += 1
+            methodDtraceDict[methodString].append(dtrace)
+
+        # removeTraces = dict()
+        # for methodString in methodAllCountDict:
+        #     removeTraces[methodString] = set()
+        #     for trace in methodAllCountDict[methodString]["traces"]:
+        #         if methodAllCountDict[methodString]["traces"][trace] < methodAllCountDict[methodString]["num"] * threshold:
+        #             removeTraces[methodString].add(trace)
+
+        methodStringList = list(methodDtraceDict)
+        if processNum > 1 and len(methodStringList) > 1:
+            # fork, so that the workers share the dtraces, the busiest methodStrings are submitted first
+            submitOrder = sorted(methodStringList, key=lambda methodString: len(methodDtraceDict[methodString]), reverse=True)
+            pool = get_context("fork").Pool(min(processNum, len(methodStringList)), initializer=_initMineWorker, initargs=(self, methodDtraceDict, threshold, batchSize))
+            try:
+                resultDict = dict(zip(submitOrder, pool.map(_mineMethodString, submitOrder, chunksize=1)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            resultDict = dict()
+            for methodString in methodStringList:
+                resultDict[methodString] = self.mineMethodString(methodString, methodDtraceDict[methodString], len(methodDtraceDict[methodString]), threshold=threshold, batchSize=batchSize)
+
+        relationDict = dict()
+        intDict = dict()
+        for methodString in methodStringList:
+            relationDict[methodString], intDict[methodString], _ = resultDict[methodString]
 
         self.invDict = relationDict
         self.keyInvDict = self.selectKeyInvs(relationDict, intDict, lowBar=lowBar)
 
         for methodString in intDict:
-            modelInvDict = self.mineMethodModel(intDict[methodString], methodAllCountDict[methodString]["num"] * threshold)
+            modelInvDict = resultDict[methodString][2]
             for modelInv in modelInvDict:
                 # print(modelInv)
                 self.keyInvDict[methodString][modelInv] = dict()
@@ -529,58 +820,6 @@ class InvHunter(object):
         return reservedInv
 
 
-    def checkInv(self, inv, invInfo, traceDict):
-        # assert keyInv in self.keyInvDict[methodString], f"{keyInv} not in self.keyInvDict"
-        if invInfo["type"] == "normal":
-            return self.checkNormalInv(inv, invInfo, traceDict=traceDict)
-        elif invInfo["type"] == "arithmetic":
-            return self.checkArithmeticInv(inv, invInfo, traceDict=traceDict)
-        elif invInfo['type'] == "inference":
-            return self.checkInferedInv(inv, invInfo, traceDict=traceDict)
-        
-    def getOrinialInv(self, relation, traceDict, variable_list = []):
-        if relation.type == "normal":
-            return relation, [self.getTraceDictVar(var, traceDict) for var in variable_list]
-        else: 
-            replacement = relation.replacement
-            replacement_value = self.getTraceDictVar(replacement, traceDict)
-            var_name_list = relation.getVars()
-            if replacement_value != "nonsensical":
-                new_variable_names = list()
-                for var_name in var_name_list:
-                    new_variable_names.append(var_name.replace(replacement, replacement_value))
-                # var_name_A, var_name_B = relation.x_name, relation.y_name
-                # var_name_A = var_name_A.replace(replacement, replacement_value)
-                # var_name_B = var_name_B.replace(replacement, replacement_value)
-                return self.getOrinialInv(relation.baseRelation, traceDict, new_variable_names)
-            else:
-                return None, ["nonsensical"] * len(var_name_list)
-
-    def checkInferedInv(self, inv, invInfo, traceDict):
-        relation = invInfo["model"]
-        normalRelation, var_value_list = self.getOrinialInv(relation, traceDict, relation.getVars())
-        # print(inv)
-        # replacement = invInfo["model"].replacement
-        # if replacement in traceDict:
-        #     replacement_value = traceDict[replacement]
-        #     var_name_A, var_name_B = invInfo["model"].getOriginalVarName(replacement_value[0])
-        # print(var_name_A, var_name_B)
-        # var_value_A = self.getTraceDictVar(var_name_A, traceDict, points)
-        # var_value_B = self.getTraceDictVar(var_name_B, traceDict, points)
-        if len(var_value_list) == 1:
-            return self.checkSingleVarInv(normalRelation, var_value_list[0])
-        elif len(var_value_list) == 2:
-            return self.checkDoubleVarInv(normalRelation, *var_value_list)
-        # if var_value_A != "nonsensical" and var_value_B != "nonsensical":
-        #     if normalRelation.checkRelation(var_value_A, var_value_B):
-        #         return "satisfy"
-        #     else:
-        #         return "violate"
-        # else:
-        #     return "exist_nonsensical"
-        # else:
-        #     return "exist_nonsensical"
-
     def checkSingleVarInv(self, relation, var_value):
         if var_value != "nonsensical":
             if relation.checkRelation(var_value):
@@ -599,18 +838,6 @@ class InvHunter(object):
         else:
             return "exist_nonsensical"
 
-    def checkNormalInv(self, inv, invInfo, traceDict):
-        if type(invInfo['model']) in SingleInvList:
-            var_name_A = invInfo['model'].x_name
-            var_value_A = self.getTraceDictVar(var_name_A, traceDict)
-            return self.checkSingleVarInv(invInfo['model'], var_value_A)
-
-        elif type(invInfo['model']) in ComparisonRelationList:
-            var_name_A, var_name_B = invInfo['model'].x_name, invInfo['model'].y_name
-            var_value_A = self.getTraceDictVar(var_name_A, traceDict)
-            var_value_B = self.getTraceDictVar(var_name_B, traceDict)
-            return self.checkDoubleVarInv(invInfo['model'], var_value_A, var_value_B)
-
     def getTraceDictVar(self, var_name, traceDict):
         if var_name in traceDict:
             var_value = traceDict[var_name]
@@ -627,46 +854,165 @@ class InvHunter(object):
             else:
                 return "nonsensical"
     
-    def checkArithmeticInv(self, inv, invInfo, traceDict):
-        modelRelation = invInfo["model"]
-        if isinstance(modelRelation, LinearRelationWithThreeVar):
-            # x_name, y_name, z_name = modelRelation.x_name, modelRelation.y_name, modelRelation.z_name
-            x_value = self.getTraceDictVar(modelRelation.x_name, traceDict)
-            y_value = self.getTraceDictVar(modelRelation.y_name, traceDict)
-            z_value = self.getTraceDictVar(modelRelation.z_name, traceDict)
-            if x_value != "nonsensical" and y_value != "nonsensical" and z_value != "nonsensical":
-                flag = "violate"
-                if modelRelation.checkRelation([x_value, y_value, z_value]):
-                    flag = "satisfy"
-                return flag
+    def getTraceVarGetter(self, traceDict):
+        # the invs of a methodString share most of their variables, look up each name once per trace
+        varCache = dict()
+        def getVar(var_name):
+            if var_name not in varCache:
+                varCache[var_name] = self.getTraceDictVar(var_name, traceDict)
+            return varCache[var_name]
+        return getVar
+
+    def compileOriginalInv(self, relation):
+        # returns resolve(getVar, variable_list) => (normalRelation, var_value_list), the variables of the base relation with the replacement filled from the trace
+        if relation.type == "normal":
+            return lambda getVar, variable_list: (relation, [getVar(var) for var in variable_list])
+        replacement = relation.replacement
+        var_name_list = relation.getVars()
+        # var_name.replace(replacement, replacement_value) == replacement_value.join(template)
+        templates = [var_name.split(replacement) if replacement != "" else None for var_name in var_name_list]
+        resolveBase = self.compileOriginalInv(relation.baseRelation)
+        def resolve(getVar, variable_list):
+            replacement_value = getVar(replacement)
+            if replacement_value != "nonsensical":
+                new_variable_names = list()
+                for var_name, template in zip(var_name_list, templates):
+                    if template == None:
+                        new_variable_names.append(var_name.replace(replacement, replacement_value))
+                    else:
+                        new_variable_names.append(str.join(replacement_value, template))
+                return resolveBase(getVar, new_variable_names)
             else:
-                return "exist_nonsensical"
-        else:
-            # x_name, y_name = modelRelation.x_name, modelRelation.y_name
-            x_value = self.getTraceDictVar(modelRelation.x_name, traceDict)
-            y_value = self.getTraceDictVar(modelRelation.y_name, traceDict)
-            if x_value != "nonsensical" and y_value != "nonsensical":
-                flag = "violate"
-                if modelRelation.checkRelation([x_value, y_value]):
-                    flag = "satisfy"
-                return flag
+                return None, ["nonsensical"] * len(var_name_list)
+        return resolve
+
+    def compileInv(self, invInfo):
+        # evaluate(getVar) returns "satisfy", "violate" or "exist_nonsensical" for the trace of getVar
+        checkSingle, checkDouble = self.checkSingleVarInv, self.checkDoubleVarInv
+        if invInfo["type"] == "normal":
+            model = invInfo['model']
+            if type(model) in SingleInvList:
+                x_name = model.x_name
+                return lambda getVar: checkSingle(model, getVar(x_name))
+            elif type(model) in ComparisonRelationList:
+                x_name, y_name = model.x_name, model.y_name
+                return lambda getVar: checkDouble(model, getVar(x_name), getVar(y_name))
+        elif invInfo["type"] == "arithmetic":
+            model = invInfo["model"]
+            if isinstance(model, LinearRelationWithThreeVar):
+                var_name_list = [model.x_name, model.y_name, model.z_name]
+            else:
+                var_name_list = [model.x_name, model.y_name]
+            def evaluate(getVar):
+                var_value_list = [getVar(var_name) for var_name in var_name_list]
+                if "nonsensical" not in var_value_list:
+                    flag = "violate"
+                    if model.checkRelation(var_value_list):
+                        flag = "satisfy"
+                    return flag
+                else:
+                    return "exist_nonsensical"
+            return evaluate
+        elif invInfo["type"] == "inference":
+            model = invInfo["model"]
+            resolve = self.compileOriginalInv(model)
+            var_name_list = model.getVars()
+            def evaluate(getVar):
+                normalRelation, var_value_list = resolve(getVar, var_name_list)
+                if len(var_value_list) == 1:
+                    return checkSingle(normalRelation, var_value_list[0])
+                elif len(var_value_list) == 2:
+                    return checkDouble(normalRelation, *var_value_list)
+            return evaluate
+        return lambda getVar: None
+
+    def getCheckPlan(self, methodString):
+        invDict = self.keyInvDict[methodString]
+        if methodString in self.checkPlans:
+            cachedInvDict, invNum, checkPlan = self.checkPlans[methodString]
+            if cachedInvDict is invDict and invNum == len(invDict):
+                return checkPlan
+        checkPlan = [(inv, self.compileInv(invInfo)) for inv, invInfo in invDict.items()]
+        self.checkPlans[methodString] = (invDict, len(invDict), checkPlan)
+        return checkPlan
+
+    """
+    check the arithmetic invs of methodString over many traces at once, returns inv => violation mask
+    the rows with only ints within 2^53 are checked by the models on int64 columns, the others by the compiled inv
+    """
+    def batchCheckArithmeticInvs(self, methodString, traceDictList):
+        getVarList = [self.getTraceVarGetter(traceDict) for traceDict in traceDictList]
+        violationMasks = dict()
+        for inv, invInfo in self.keyInvDict[methodString].items():
+            if invInfo["type"] != "arithmetic":
+                continue
+            model = invInfo["model"]
+            if isinstance(model, LinearRelationWithThreeVar):
+                var_name_list = [model.x_name, model.y_name, model.z_name]
             else:
-                return "exist_nonsensical"
+                var_name_list = [model.x_name, model.y_name]
+            columns = [[getVar(var_name) for getVar in getVarList] for var_name in var_name_list]
+            exact = np.ones(len(traceDictList), dtype=bool)
+            for column in columns:
+                exact &= np.array([type(var_value) == int and -2**53 <= var_value <= 2**53 for var_value in column], dtype=bool)
+
+            violation = np.zeros(len(traceDictList), dtype=bool)
+            if exact.any():
+                data = [np.array(column, dtype=object)[exact].astype(np.int64) for column in columns]
+                violation[exact] = ~np.asarray(model.batchCheckRelation(data), dtype=bool)
+            if not exact.all():
+                evaluate = self.compileInv(invInfo)
+                for index in np.flatnonzero(~exact):
+                    violation[index] = evaluate(getVarList[index]) == "violate"
+            violationMasks[inv] = violation
+        return violationMasks
+
+    def recordViolation(self, violatedTxs, label, methodString, var_dict, level, violation):
+        if len(violation) > 0:
+            violatedTxs[label] = dict()
+            violatedTxs[label]["methodString"] = methodString
+            violatedTxs[label]["msg.sender"] = var_dict["from"]
+            violatedTxs[label]["tx.origin"] = var_dict["tx.origin"]
+            violatedTxs[label]["violations"] = list(violation)
+            violatedTxs[label]["level"] = level
+            print(label, methodString)
+            # for vio in violation:
+            #     print(vio)
+            # print(traceDict)
+            # with open(f"{block_tx}_trace_dict.json", "w") as f:
+            #     json.dump(traceDict, f)
+        else:
+            # print(block_tx, methodString, "safe")
+            pass
 
-    def checkInvs(self, startBlock, endBlock, txPath):
+    """
+    each trace is built once, for both checking and the returned dtraceList
+    dumpTraces=False only decodes the variables used by the invs and returns an empty dtraceList
+    batchCheck=True is the backfill mode: the arithmetic invs are checked per methodString over all the traces by batchCheckArithmeticInvs, the same violatedTxs
+    """
+    def checkInvs(self, startBlock, endBlock, txPath, processNum=1, dumpTraces=True, batchCheck=False):
 
-        var_dict_list = self.contract.readVarDict(startBlock=startBlock, endBlock=endBlock, txNum=1000, mode="check", txPath=txPath, dumpBool=True, excludePartialErr=True)
+        var_dict_list = self.contract.readVarDict(startBlock=startBlock, endBlock=endBlock, txNum=1000, mode="check", txPath=txPath, dumpBool=True, excludePartialErr=True, processNum=processNum)
         print("length of var_dict", len(var_dict_list))
-        dtraceList = self.contract.extractDtrace(var_dict_list)
-        print("CHECKING: length of dtraceList", len(dtraceList))
+        dtraceList = list()
         violatedTxs = dict()
         tx_set = set()
+        batchTraceDict = dict() # map methodString => [traceDict], for batchCheck
+        pendingChecks = list() # (label, methodString, var_dict, level, violation, row in batchTraceDict), for batchCheck
         for var_dict in var_dict_list:
         # for dtrace in dtraceList:
             function = var_dict["name"]
             branch = var_dict["branch"]
             methodString = None
             level = None
+            # the variables are decoded when the invs of a level ask for them, shared by the levels
+            builder = None
+            levelTraceDict = dict()
+            if dumpTraces:
+                builder = self.contract.getTraceBuilder(var_dict)
+                levelTraceDict = self.contract.extractLevelTraceDict(var_dict, builder=builder)
+                # the same dtraces as extractDtrace
+                dtraceList.extend(self.contract.getLevelDtraces(var_dict, levelTraceDict))
             
             # is branch
             for level in ["branch", "function", "contract"]:
@@ -688,35 +1034,47 @@ class InvHunter(object):
                 if methodString not in self.keyInvDict:
                     continue
 
-                traceDict = self.contract.extractFuncDtraceInfo(var_dict, level)
+                if level in levelTraceDict:
+                    traceDict = levelTraceDict[level]
+                else:
+                    if builder == None:
+                        builder = self.contract.getTraceBuilder(var_dict)
+                    traceDict = LazyTraceDict(builder, level)
                 tx_set.add(f"{var_dict['blockNumber']}_{var_dict['position']}")
                 label = f"{var_dict['blockNumber']}_{var_dict['position']}_{var_dict['index']}:{level}"
 
                 violation = list()
 
                 # deal with invs
-                for inv, invInfo in self.keyInvDict[methodString].items():
-                    res = self.checkInv(inv, invInfo, traceDict)
-                    if res == "violate":
+                getVar = self.getTraceVarGetter(traceDict)
+                invDict = self.keyInvDict[methodString]
+                for inv, evaluate in self.getCheckPlan(methodString):
+                    if batchCheck and invDict[inv]["type"] == "arithmetic":
+                        continue
+                    if evaluate(getVar) == "violate":
                         violation.append(inv)
-                
-                if len(violation) > 0:
-                    violatedTxs[label] = dict()
-                    violatedTxs[label]["methodString"] = methodString
-                    violatedTxs[label]["msg.sender"] = var_dict["from"]
-                    violatedTxs[label]["tx.origin"] = var_dict["tx.origin"]
-                    violatedTxs[label]["violations"] = list(violation)
-                    violatedTxs[label]["level"] = level
-                    print(label, methodString)
-                    # for vio in violation:
-                    #     print(vio)
-                    # print(traceDict)
-                    # with open(f"{block_tx}_trace_dict.json", "w") as f:
-                    #     json.dump(traceDict, f)
+
+                if batchCheck:
+                    if methodString not in batchTraceDict:
+                        batchTraceDict[methodString] = list()
+                    pendingChecks.append((label, methodString, var_dict, level, violation, len(batchTraceDict[methodString])))
+                    batchTraceDict[methodString].append(traceDict)
                 else:
-                    # print(block_tx, methodString, "safe")
-                    pass
+                    self.recordViolation(violatedTxs, label, methodString, var_dict, level, violation)
+
+        if batchCheck:
+            violationMaskDict = dict()
+            for methodString, traceDictList in batchTraceDict.items():
+                violationMaskDict[methodString] = self.batchCheckArithmeticInvs(methodString, traceDictList)
+            for label, methodString, var_dict, level, violation, row in pendingChecks:
+                violationMasks = violationMaskDict[methodString]
+                if len(violationMasks) > 0:
+                    # merge in the order of the invs, as the checking of one trace
+                    violated = set(violation)
+                    violation = [inv for inv, _ in self.getCheckPlan(methodString) if inv in violated or (inv in violationMasks and violationMasks[inv][row])]
+                self.recordViolation(violatedTxs, label, methodString, var_dict, level, violation)
 
+        print("CHECKING: length of dtraceList", len(dtraceList))
         return dtraceList, len(tx_set), violatedTxs
     
     def loadMinedInvs(self, path):
@@ -14,6 +14,9 @@ def get_args():
     parser.add_argument('--threshold', dest='threshold', type=float, default=1)
     parser.add_argument('--output_path', dest='output_path', type=str, default="invs")
     parser.add_argument('-ignore_exist', dest='ignore_exist', action="store_true")
+    parser.add_argument('--process_num', dest='process_num', type=int, default=1)
+    parser.add_argument('-skip_checked_dtraces', dest='skip_checked_dtraces', action="store_true")
+    parser.add_argument('-batch_check', dest='batch_check', action="store_true")
     args = parser.parse_args()
     return args
 
@@ -103,26 +106,33 @@ dapp_dict = {
     # "20220801_nomad_bridge":[0, 15259100, 15259101, 15500000],
 }
 
+"""
+proxyAddrs restricts the dapp to some of its contracts, the scheduler runs each contract as a task
+phaseTimes maps proxyAddr => the seconds of the ingest, extract, mine and check phases of the last run
+"""
 class Dapp(object):
 
-    def __init__(self, dapp, txPathSource, configPath, outputPath):
+    def __init__(self, dapp, txPathSource, configPath, outputPath, proxyAddrs=None):
 
         assert os.path.exists(f"{configPath}/{dapp}/config.json"), f"not exising {configPath}/{dapp}/config.json"
         with open(f"{configPath}/{dapp}/config.json", "r") as f:
             config = json.load(f)
         
-        if not os.path.exists(f"{outputPath}/{dapp}"):
-            os.mkdir(f"{outputPath}/{dapp}")
+        # the contracts of a dapp may be created by concurrent tasks
+        os.makedirs(f"{outputPath}/{dapp}", exist_ok=True)
 
         self.dapp = dapp
         self.txPathSource = txPathSource
         self.outputPath = outputPath
         self.invHunters = dict()
+        self.phaseTimes = dict()
         for proxyAddr in config:
+            if proxyAddrs != None and proxyAddr not in proxyAddrs:
+                continue
             contract = Contract(proxyAddr=proxyAddr, contractConfig=config[proxyAddr], sourcePath=f"{configPath}/{dapp}/{proxyAddr}", outputPath=f"{outputPath}/{dapp}/{proxyAddr}")
             self.invHunters[proxyAddr] = InvHunter(contract)
 
-    def run(self, txNum, threshold, ignore_exist=True, dumpTime=False):
+    def run(self, txNum, threshold, ignore_exist=True, dumpTime=False, processNum=1, dumpCheckedTraces=True, batchCheck=False):
         for proxyAddr, hunter in self.invHunters.items():
             outputTargetPath = f"{self.outputPath}/{self.dapp}/{proxyAddr}/result/{txNum}_{threshold}"
 
@@ -140,9 +150,11 @@ class Dapp(object):
             print("start mining")
             mining_start_time = time.time()
             benignTxPath=f"{self.txPathSource}/{self.dapp}/{proxyAddr}"
-            hunter.contract.var_dict_list = hunter.contract.readVarDict(startBlock=dapp_dict[self.dapp][0], endBlock=dapp_dict[self.dapp][1], txNum=txNum, mode="mine", txPath=benignTxPath, dumpBool=True, excludePartialErr=True)
+            hunter.contract.var_dict_list = hunter.contract.readVarDict(startBlock=dapp_dict[self.dapp][0], endBlock=dapp_dict[self.dapp][1], txNum=txNum, mode="mine", txPath=benignTxPath, dumpBool=True, excludePartialErr=True, processNum=processNum)
+            ingest_end_time = time.time()
             dtraceList = hunter.contract.extractDtrace(hunter.contract.var_dict_list, useCachedStorage=False)
-            mined_dtraceList, methodAllCountDict = hunter.incrementalAlg(dtraceList,threshold=threshold, lowBar=0, max_methodCount=100)
+            extract_end_time = time.time()
+            mined_dtraceList, methodAllCountDict = hunter.incrementalAlg(dtraceList,threshold=threshold, lowBar=0, max_methodCount=100, processNum=processNum)
             mining_end_time = time.time()
             print("end mining")
             with open(f"{outputTargetPath}/mine_methodAllCountDict.json", "w") as f:
@@ -154,9 +166,17 @@ class Dapp(object):
 
             print("start checking")
             checking_start_time = time.time()
-            checked_dtraceList, checked_txs_num, violatedTxs = hunter.checkInvs(startBlock=dapp_dict[self.dapp][2], endBlock=dapp_dict[self.dapp][3], txPath=f"{self.txPathSource}/{self.dapp}/{proxyAddr}")
+            checked_dtraceList, checked_txs_num, violatedTxs = hunter.checkInvs(startBlock=dapp_dict[self.dapp][2], endBlock=dapp_dict[self.dapp][3], txPath=f"{self.txPathSource}/{self.dapp}/{proxyAddr}", processNum=processNum, dumpTraces=dumpCheckedTraces, batchCheck=batchCheck)
             checking_end_time = time.time()
-            hunter.dumpTrace(checked_dtraceList, f"{outputTargetPath}/checked_dtraces.json")
+            if dumpCheckedTraces:
+                hunter.dumpTrace(checked_dtraceList, f"{outputTargetPath}/checked_dtraces.json")
+
+            self.phaseTimes[proxyAddr] = {
+                "ingest" : ingest_end_time - mining_start_time,
+                "extract" : extract_end_time - ingest_end_time,
+                "mine" : mining_end_time - extract_end_time,
+                "check" : checking_end_time - checking_start_time,
+            }
 
             print("mining time: %.3f, number of txs: %d" % (mining_end_time - mining_start_time, len(mined_dtraceList)))
             print("checking time %.3f, number of txs: %d" % (checking_end_time - checking_start_time, checked_txs_num))
@@ -181,16 +201,19 @@ if __name__ == "__main__":
     threshold = args.threshold
     ignore_exist = args.ignore_exist
     ignore_exist = False
+    process_num = args.process_num
+    dump_checked_dtraces = not args.skip_checked_dtraces
+    batch_check = args.batch_check
     configPath = f"../dapps"
     txPathSource = "../dapps_tx"
     if targetDapp == "all":
         for targetDapp in dapp_dict:
             print(f"analyzing {targetDapp}")
             dapp = Dapp(targetDapp, txPathSource=txPathSource, configPath=configPath, outputPath=outputPath)
-            dapp.run(train_num, threshold, ignore_exist)
+            dapp.run(train_num, threshold, ignore_exist, processNum=process_num, dumpCheckedTraces=dump_checked_dtraces, batchCheck=batch_check)
     elif targetDapp in dapp_dict:
         print(f"analyzing {targetDapp}")
         dapp = Dapp(targetDapp, txPathSource=txPathSource, configPath=configPath, outputPath=outputPath)
-        dapp.run(train_num, threshold, ignore_exist)
+        dapp.run(train_num, threshold, ignore_exist, processNum=process_num, dumpCheckedTraces=dump_checked_dtraces, batchCheck=batch_check)
     else:
         print(f"not existing {targetDapp}")
\ No newline at end of file
@@ -1,7 +1,4 @@
 import numpy as np
-import statsmodels.api as sm
-from sklearn.linear_model import LinearRegression
-from sklearn.preprocessing import PolynomialFeatures
 
 def less(varA, varB):
     return varA < varB
@@ -15,6 +12,13 @@ def opposite(varA, varB):
 def equal(varA, varB):
     return varA == varB
 
+def fitLeastSquares(design, y):
+    # returns params and the centered R^2
+    params = np.linalg.lstsq(design, y, rcond=None)[0]
+    residual = y - design @ params
+    centered = y - y.mean()
+    return params, 1 - (residual @ residual) / (centered @ centered)
+
 def inList(var, varList):
     if var in varList:
         return True, varList.index(var)
@@ -276,6 +280,11 @@ class LinearRelationWithThreeVar(object):
         z = data[2]
         return z == x + y
 
+    def batchCheckRelation(self, data):
+        # data: the int64 columns of x, y, z, |value| <= 2^53
+        x, y, z = data
+        return z == x + y
+
 class LinearRelation(object):
 
     def __init__(self, x_name, y_name) -> None:
@@ -290,34 +299,9 @@ class LinearRelation(object):
         return f"{self.y_name} = {self.a} * {self.x_name} + {self.b}"
 
     def constructRelation(self, data, threshold=1):
-        # if successfully find model, return True, model
-        # else return False, None
-        data = np.array(data, dtype=np.int64)
-
-        x = data[:, 0]  
-        y = data[:, 1]  
-
-        x = sm.add_constant(x)
-
-        model = sm.OLS(y, x).fit()
-        self.model = model
-
-        r_squared_value = model.rsquared
-
-        if r_squared_value >= threshold and abs(model.params[1]) > 1e-5 and self.checkRelation([x[0],y[0]]):
-            violate = False
-            for item in data:
-                if not self.checkRelation(item):
-                    violate = True
-                    break
-            if violate or abs((model.params[1] - 1) < 1e-5 and abs(model.params[0]) < 1e-5):
-                return False
-            else:
-                self.a = self.model.params[1]
-                self.b = self.model.params[0]
-                return True
-        else:
-            return False
+        # never accepted: the OLS version checked its first design row [1, x] as the x of checkRelation,
+        # the truth value of that array raised and mineMethodModel swallowed it, so nothing is fitted
+        return False
 
     def checkRelation(self, data):
         # if the data fit the model, return true, else false
@@ -329,6 +313,12 @@ class LinearRelation(object):
         b = self.b
         predicted_y = a * x + b
         return (predicted_y - y) < 1e-5
+
+    def batchCheckRelation(self, data):
+        # data: the int64 columns of x, y, |value| <= 2^53, so the float64 conversion is exact
+        x, y = data
+        predicted_y = self.a * x.astype(np.float64) + self.b
+        return (predicted_y - y) < 1e-5
     
     def dumpModel(self):
         return {
@@ -369,13 +359,15 @@ class QuadraticRelation(object):
         y = data[:, 1]  
 
         x_poly = np.column_stack((x**2, x))
+        # sm.add_constant skipped the constant column when x^2 or x was a nonzero constant, that fit had no c and was never kept
+        if ((np.ptp(x_poly, axis=0) == 0) & np.all(x_poly != 0, axis=0)).any():
+            return False
+        design = np.column_stack((np.ones(len(x)), x_poly)).astype(np.float64)
 
-        model = sm.OLS(y, sm.add_constant(x_poly)).fit()
-        self.model = model
-
-        r_squared_value = model.rsquared
+        params, r_squared_value = fitLeastSquares(design, y.astype(np.float64))
+        self.model = (params, r_squared_value)
 
-        if r_squared_value >= threshold and abs(model.params[1]) > 1e-5 and self.checkRelation([x[0],y[0]]):
+        if r_squared_value >= threshold and abs(params[1]) > 1e-5 and self.checkRelation([x[0],y[0]]):
             violate = False
             for item in data:
                 if not self.checkRelation(item):
@@ -384,9 +376,9 @@ class QuadraticRelation(object):
             if violate:
                 return False
             else:
-                self.a = self.model.params[1]
-                self.b = self.model.params[2]
-                self.c = self.model.params[0]
+                self.a = params[1]
+                self.b = params[2]
+                self.c = params[0]
                 return True
         else:
             return False
@@ -402,6 +394,13 @@ class QuadraticRelation(object):
         c = self.c
         predicted_y = a * x**2 + b * x + c
         return (predicted_y - y) < 1e-5
+
+    def batchCheckRelation(self, data):
+        # the float64 square is the rounded exact square, the same as a * x**2
+        x, y = data
+        x = x.astype(np.float64)
+        predicted_y = self.a * x**2 + self.b * x + self.c
+        return (predicted_y - y) < 1e-5
     
     def dumpModel(self):
         return {
@@ -434,34 +433,9 @@ class InverseRelation(object):
         return f"{self.x_name} * {self.y_name} = {self.k}"
 
     def constructRelation(self, data, threshold=1):
-
-        data_new = []
-        for varXY in data:
-            varX, varY = 1/varXY[0], varXY[1]
-            data_new.append([varX, varY])
-        data_new = np.array(data_new, dtype=np.int64)
-
-        x = data_new[:, 0]
-        y = data_new[:, 1]
-
-        model = sm.OLS(y, x, hasconst=False).fit()
-        self.model = model
-
-        r_squared_value = model.rsquared
-
-        if r_squared_value >= threshold and abs(model.params[0]) > 1e-5:
-            violate = False
-            for item in data:
-                if not self.checkRelation(item):
-                    violate = True
-                    break
-            if violate:
-                return False
-            else:
-                self.k = self.model.params[0]
-                return True
-        else:
-            return False
+        # never accepted: the OLS version ran checkRelation (assert k != 0) before k was set,
+        # the assert raised and mineMethodModel swallowed it, so nothing is fitted
+        return False
 
     def checkRelation(self, data):
         assert self.k != 0
@@ -469,6 +443,11 @@ class InverseRelation(object):
         y = data[1]
         k = self.k
         return (x * y - k) < 1e-5
+
+    def batchCheckRelation(self, data):
+        # the float64 product is the rounded exact product, the same as x * y - k
+        x, y = data
+        return (x.astype(np.float64) * y.astype(np.float64) - self.k) < 1e-5
     
     def dumpModel(self):
         return {
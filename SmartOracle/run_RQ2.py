@@ -1,18 +1,15 @@
-from multiprocessing import Pool
+from scheduler import Scheduler
 from main import *
 
-def run_RQ2_util(targetDapp):
-    configPath = f"dapps"
-    txPathSource = "dapps_tx"
-    outputPath = "invs_new_0322"
-    train_num = 2000
-    # for item in range(90,101,2):
-    for item in [98]:
-        threshold = item / 100
-        dapp = Dapp(targetDapp, txPathSource=txPathSource, configPath=configPath, outputPath=outputPath)
-        dapp.run(train_num, threshold=threshold)
+configPath = f"dapps"
+txPathSource = "dapps_tx"
+outputPath = "invs_new_0322"
+train_num = 2000
+# threshold_list = range(90,101,2)
+threshold_list = [98]
 
 if __name__ == "__main__":
     dapp_list = list(dapp_dict)
-    with Pool(15) as p:
-        p.map(run_RQ2_util, dapp_list)
\ No newline at end of file
+    runs = [{"txNum": train_num, "threshold": item / 100} for item in threshold_list]
+    scheduler = Scheduler(configPath=configPath, txPathSource=txPathSource, outputPath=outputPath, processNum=15)
+    scheduler.run(dapp_list, runs)
\ No newline at end of file
@@ -0,0 +1,170 @@
+from main import Dapp
+from multiprocessing import get_context
+import traceback
+import resource
+import signal
+import time
+import json
+import os
+
+Phases = ["ingest", "extract", "mine", "check"]
+
+class TaskTimeout(Exception):
+    pass
+
+"""
+the seconds each (dapp, proxyAddr) task spent in its phases, kept in a json file between the runs
+map "dapp/proxyAddr" => {"txFiles": number of tx files, phase: seconds}
+"""
+class TaskTimings(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.timings = dict()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.timings = json.load(f)
+
+    def getKey(self, dapp, proxyAddr):
+        return f"{dapp}/{proxyAddr}"
+
+    def getSeconds(self, dapp, proxyAddr):
+        key = self.getKey(dapp, proxyAddr)
+        if key not in self.timings:
+            return None
+        return sum(self.timings[key].get(phase, 0) for phase in Phases)
+
+    def getSecondsPerTxFile(self):
+        seconds = 0
+        txFiles = 0
+        for timing in self.timings.values():
+            seconds += sum(timing.get(phase, 0) for phase in Phases)
+            txFiles += timing["txFiles"]
+        if txFiles == 0:
+            return 1
+        return seconds / txFiles
+
+    def update(self, dapp, proxyAddr, txFiles, phaseTimes):
+        self.timings[self.getKey(dapp, proxyAddr)] = dict(phaseTimes, txFiles=txFiles)
+
+    def dump(self):
+        with open(self.path, "w") as f:
+            json.dump(self.timings, f, indent=2)
+
+# each worker runs one task and exits (maxtasksperchild=1), so the limits and the memory do not outlive the task
+_taskArgs = None
+
+def _initTaskWorker(configPath, txPathSource, outputPath, runs, memLimit, timeLimit):
+    global _taskArgs
+    _taskArgs = (configPath, txPathSource, outputPath, runs, memLimit, timeLimit)
+
+def _raiseTimeout(signum, frame):
+    raise TaskTimeout()
+
+def _runTask(task):
+    configPath, txPathSource, outputPath, runs, memLimit, timeLimit = _taskArgs
+    dapp, proxyAddr = task
+    if memLimit != None:
+        resource.setrlimit(resource.RLIMIT_AS, (memLimit, memLimit))
+    if timeLimit != None:
+        signal.signal(signal.SIGALRM, _raiseTimeout)
+        signal.alarm(timeLimit)
+
+    phaseTimes = dict([(phase, 0) for phase in Phases])
+    error = None
+    try:
+        for run in runs:
+            # a new Dapp for each run, as the drivers do
+            dappRunner = Dapp(dapp, txPathSource=txPathSource, configPath=configPath, outputPath=outputPath, proxyAddrs=[proxyAddr])
+            dappRunner.run(**run)
+            for phase, seconds in dappRunner.phaseTimes.get(proxyAddr, dict()).items():
+                phaseTimes[phase] += seconds
+    except TaskTimeout:
+        error = f"timeout after {timeLimit}s"
+    except MemoryError:
+        error = f"out of memory, limit {memLimit} bytes"
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        if timeLimit != None:
+            signal.alarm(0)
+    return dapp, proxyAddr, phaseTimes, error
+
+"""
+runs the dapps as (dapp, proxyAddr) tasks on a shared task queue
+runs: the keyword arguments of Dapp.run, run in order in each task
+the phases of a contract are not separate tasks: extract, mine and check work on the in-memory var_dicts, dtraces and invs
+of the phases before them, so the phase timings only size the tasks
+the var_dict cache of a contract is locked by its writers (VarDictStore), so tasks sharing an outputPath do not race on it
+the tasks are queued by their historical seconds, the longest first, so the stragglers start early and the idle workers take the next task
+a task never seen before is sized by its tx files
+memLimit (bytes) and timeLimit (seconds) bound each task, a task over a limit is reported and the others go on
+each worker holds a whole contract run (var_dicts, dtraces and invs) in memory, so processNum is bounded by the memory rather than the cores
+the workers are daemonic and can not start pools, so the runs can not set processNum of Dapp.run
+"""
+class Scheduler(object):
+
+    def __init__(self, configPath, txPathSource, outputPath, processNum=1, memLimit=None, timeLimit=None, timingPath=None):
+        self.configPath = configPath
+        self.txPathSource = txPathSource
+        self.outputPath = outputPath
+        self.processNum = processNum
+        self.memLimit = memLimit
+        self.timeLimit = timeLimit
+        os.makedirs(outputPath, exist_ok=True)
+        self.timings = TaskTimings(timingPath if timingPath != None else f"{outputPath}/task_timings.json")
+
+    def getTasks(self, dapp_list):
+        tasks = list()
+        for dapp in dapp_list:
+            if not os.path.exists(f"{self.configPath}/{dapp}/config.json"):
+                print(f"not exising {self.configPath}/{dapp}/config.json")
+                continue
+            with open(f"{self.configPath}/{dapp}/config.json", "r") as f:
+                config = json.load(f)
+            for proxyAddr in config:
+                tasks.append((dapp, proxyAddr))
+        return tasks
+
+    def countTxFiles(self, dapp, proxyAddr):
+        txPath = f"{self.txPathSource}/{dapp}/{proxyAddr}"
+        if not os.path.exists(txPath):
+            return 0
+        return len(os.listdir(txPath))
+
+    def getCost(self, dapp, proxyAddr, txFiles, secondsPerTxFile):
+        seconds = self.timings.getSeconds(dapp, proxyAddr)
+        if seconds == None:
+            seconds = txFiles * secondsPerTxFile
+        return seconds
+
+    def run(self, dapp_list, runs):
+        for run in runs:
+            assert run.get("processNum", 1) <= 1, f"processNum > 1 in {run}, a task can not start a pool in a daemonic worker"
+        tasks = self.getTasks(dapp_list)
+        txFilesDict = dict()
+        for dapp, proxyAddr in tasks:
+            txFilesDict[(dapp, proxyAddr)] = self.countTxFiles(dapp, proxyAddr)
+        secondsPerTxFile = self.timings.getSecondsPerTxFile()
+        tasks.sort(key=lambda task: self.getCost(task[0], task[1], txFilesDict[task], secondsPerTxFile), reverse=True)
+        print(f"scheduling {len(tasks)} tasks of {len(dapp_list)} dapps on {self.processNum} processes")
+
+        failedTasks = list()
+        start_time = time.time()
+        pool = get_context("fork").Pool(self.processNum, initializer=_initTaskWorker, initargs=(self.configPath, self.txPathSource, self.outputPath, runs, self.memLimit, self.timeLimit), maxtasksperchild=1)
+        try:
+            for dapp, proxyAddr, phaseTimes, error in pool.imap_unordered(_runTask, tasks, chunksize=1):
+                if error != None:
+                    print(f"failed {dapp} {proxyAddr}: {error}")
+                    failedTasks.append((dapp, proxyAddr))
+                    continue
+                print(f"finished {dapp} {proxyAddr} in %.3f" % sum(phaseTimes.values()))
+                # the skipped runs (ignore_exist) take no time, keep the timing of the last real run
+                if sum(phaseTimes.values()) > 0:
+                    self.timings.update(dapp, proxyAddr, txFilesDict[(dapp, proxyAddr)], phaseTimes)
+                    self.timings.dump()
+        finally:
+            pool.close()
+            pool.join()
+        print("scheduling time: %.3f, failed tasks: %d" % (time.time() - start_time, len(failedTasks)))
+        return failedTasks
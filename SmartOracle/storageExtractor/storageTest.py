@@ -1,13 +1,15 @@
 from web3 import Web3
 from functools import lru_cache
 from eth_abi import decode
+import sha3
 import json
 import math
+import re
 
-# for mapping
-@lru_cache
-def soliditySha3(key:int, slot:int):
-    return Web3.soliditySha3(["uint256", "uint256"], [key, slot])
+# for mapping, the same as Web3.soliditySha3(["uint256", "uint256"], [key, slot])
+def soliditySha3(key:int, slot:int) -> str:
+    # to_bytes raises OverflowError for the keys out of uint256
+    return "0x" + sha3.keccak_256(key.to_bytes(32, "big") + slot.to_bytes(32, "big")).hexdigest()
         
 def normalizeArg(data):
     if type(data) == bytes:
@@ -55,12 +57,51 @@ def getByteNum(var_type):
         return 32
     return 32
 
+@lru_cache(maxsize=None)
+def getWordFieldType(var_type):
+    # (kind, bits) of the types read from the storage word with shifts and masks, None for the others
+    if var_type == "bool":
+        return ("bool", 8)
+    elif var_type == "address":
+        return ("address", 160)
+    match = re.fullmatch(r"(uint|int|bytes)(\d+)", var_type)
+    if match != None:
+        kind, size = match.group(1), int(match.group(2))
+        if kind == "bytes" and 1 <= size <= 32:
+            return (kind, size * 8)
+        elif kind != "bytes" and size % 8 == 0 and 8 <= size <= 256:
+            return (kind, size)
+    return None
+
+def decodeWordField(fieldType, field):
+    # field is the zero padded value, None when the abi decoder rejects the padding
+    kind, bits = fieldType
+    if kind == "uint":
+        return field if field >> bits == 0 else None
+    elif kind == "int":
+        field = field & ((1 << bits) - 1)
+        if field >> (bits - 1):
+            field -= 1 << bits
+        return field
+    elif kind == "bool":
+        return field == 1 if field >> 1 == 0 else None
+    elif kind == "address":
+        return "0x%040x" % field if field >> 160 == 0 else None
+    else:
+        # bytesN is left aligned in the padded word
+        paddingBits = 256 - bits
+        if field & ((1 << paddingBits) - 1):
+            return None
+        return "0x" + format(field >> paddingBits, f"0{bits // 4}x")
+
+# shared by all the points and txs of a run
+@lru_cache(maxsize=1 << 20)
 def calMappingKey(key, slot):
     try:
         if isinstance(key, str):
             key = int(key, 16)
         slot = int(slot, 16)
-        return soliditySha3(key, slot).hex()
+        return soliditySha3(key, slot)
     except:
         return None
 
@@ -77,11 +118,56 @@ def travelArg(arg, keySet):
         if type(arg) == int:
             keySet.add(arg)
 
+"""
+the storage layout expanded with the mapping keys of one call, built once and shared by all the points of the call
+a node is one of
+    ("value", slot, offset, numberOfBytes, label)
+    ("struct", [(label, node), ...])
+    ("mapping", slot, valueType, {key: (targetSlot, node)})
+    ("array", slot, type, offset, numberOfBytes), the elements depend on the stored length
+slotIndex maps a slot to the paths ((id(node), key), ...) from a variable to the nodes reading the slot,
+so a point can go from its touched slots to the variables instead of walking the whole layout
+"""
+class SlotPlan(object):
+
+    def __init__(self, mappingKeys):
+        self.mappingKeys = mappingKeys
+        self.keyOrder = {key: index for index, key in enumerate(mappingKeys)}
+        self.variables = list()
+        self.mappingVariables = list()
+        self.slotIndex = dict()
+        self.newPaths = list()
+        # map id(node) => the extra keys already expanded under a mapping node
+        self.expandedKeys = dict()
+
+    def addSlot(self, slot, path):
+        if slot not in self.slotIndex:
+            self.slotIndex[slot] = list()
+        self.slotIndex[slot].append(path)
+        self.newPaths.append((slot, path))
+
+    def activate(self, active, path):
+        for nodeId, key in path:
+            if nodeId not in active:
+                active[nodeId] = set()
+            active[nodeId].add(key)
+
+    def touchedNodes(self, storageMap):
+        # map id(node) => the keys of the touched children, for the nodes on the path of a touched slot
+        active = dict()
+        for slot in storageMap:
+            if slot in self.slotIndex:
+                for path in self.slotIndex[slot]:
+                    self.activate(active, path)
+        return active
+
 class StateVariableExtractor(object):
 
     def __init__(self, storageLayout) -> None:
         self.storage = storageLayout['storage']
         self.types = storageLayout['types']
+        # map slot value => int, each word is converted once for all the fields packed in it
+        self.slotWords = dict()
 
     def searchKeys(self, var_dict):
         keySet = set()
@@ -103,6 +189,7 @@ class StateVariableExtractor(object):
 
     def loadStateVariable(self, storageMap, mappingKeys):
         self.newMappingKeys = set()
+        self.slotWords = dict()
         stateVariableDict = dict()
         mappingStateVariable = []
         for storageInfo in self.storage:
@@ -128,6 +215,158 @@ class StateVariableExtractor(object):
 
         return stateVariableDict
 
+    def buildSlotPlan(self, var_dict):
+        slotPlan = SlotPlan(self.searchKeys(var_dict))
+        for storageInfo in self.storage:
+            stateVariableInfo = self.getStateVariableInfo(storageInfo['type'])
+            tmpSlot = hex(int(storageInfo["slot"])).replace("0x", "")
+            slot = "0x" + "0" * (64 - len(tmpSlot)) + tmpSlot
+            node = self.buildSlotNode(slot, storageInfo['type'], storageInfo["offset"], stateVariableInfo["numberOfBytes"], slotPlan.mappingKeys, slotPlan, ())
+            # the same order as loadStateVariable, mappings are decoded at last
+            if "mapping" in storageInfo["type"]:
+                slotPlan.mappingVariables.append((storageInfo["label"], node))
+            else:
+                slotPlan.variables.append((storageInfo["label"], node))
+        slotPlan.newPaths = list()
+        return slotPlan
+
+    def buildSlotNode(self, slot, stateVariableType, offset, numberOfBytes, mappingKeys, slotPlan, path):
+        stateVariableInfo = self.getStateVariableInfo(stateVariableType)
+        if stateVariableInfo["encoding"] == "dynamic_array":
+            node = ("array", slot, stateVariableType, offset, numberOfBytes)
+            slotPlan.addSlot(slot, path + ((id(node), None),))
+            return node
+        elif stateVariableInfo["encoding"] == "mapping":
+            node = ("mapping", slot, stateVariableInfo['value'], dict())
+            for key in mappingKeys:
+                self.expandMappingKey(node, key, mappingKeys, slotPlan, path)
+            return node
+        elif stateVariableInfo["encoding"] == "inplace" and "members" in stateVariableInfo:
+            memberList = list()
+            node = ("struct", memberList)
+            loadedByteInSlot = 0
+            thisSlot = slot
+            for member in stateVariableInfo["members"]:
+                memberType = member["type"]
+                memberTypeInfo = self.getStateVariableInfo(memberType)
+                numberOfBytes = memberTypeInfo["numberOfBytes"]
+                if loadedByteInSlot + numberOfBytes > 32:
+                    loadedByteInSlot = 0
+                    thisSlot = slotAdd(thisSlot, 1)
+                memberList.append((member['label'], self.buildSlotNode(thisSlot, memberType, loadedByteInSlot, numberOfBytes, mappingKeys, slotPlan, path + ((id(node), None),))))
+                loadedByteInSlot += numberOfBytes
+            return node
+        elif stateVariableInfo["encoding"] == "inplace" or stateVariableInfo["encoding"] == "bytes":
+            node = ("value", slot, offset, numberOfBytes, stateVariableInfo["label"])
+            slotPlan.addSlot(slot, path + ((id(node), None),))
+            return node
+        else:
+            assert False, f"unknow {stateVariableType}"
+
+    def expandMappingKey(self, node, key, mappingKeys, slotPlan, path):
+        _, slot, valueType, children = node
+        if key not in children:
+            targetSlot = calMappingKey(key, slot)
+            if targetSlot != None:
+                children[key] = (targetSlot, self.buildSlotNode(targetSlot, valueType, 0, 32, mappingKeys, slotPlan, path + ((id(node), key),)))
+            else:
+                children[key] = (None, None)
+        return children[key]
+
+    def expandSlotPlan(self, node, extraKeys, mappingKeys, slotPlan, path):
+        # add the keys found at a point to every mapping under node, each key once per node for the whole call
+        # always recurse, the children added by an earlier point were built without the keys of the other points
+        if node[0] == "mapping":
+            if id(node) not in slotPlan.expandedKeys:
+                slotPlan.expandedKeys[id(node)] = set()
+            expandedKeys = slotPlan.expandedKeys[id(node)]
+            for key in extraKeys:
+                if key not in expandedKeys:
+                    expandedKeys.add(key)
+                    self.expandMappingKey(node, key, mappingKeys, slotPlan, path)
+            for key, (targetSlot, childNode) in list(node[3].items()):
+                if childNode != None:
+                    self.expandSlotPlan(childNode, extraKeys, mappingKeys, slotPlan, path + ((id(node), key),))
+        elif node[0] == "struct":
+            for _, memberNode in node[1]:
+                self.expandSlotPlan(memberNode, extraKeys, mappingKeys, slotPlan, path + ((id(node), None),))
+
+    def loadStateVariableByPlan(self, storageMap, slotPlan):
+        # the same result as loadStateVariable(storageMap, slotPlan.mappingKeys)
+        self.newMappingKeys = set()
+        self.slotWords = dict()
+        active = None
+        if len(storageMap) < len(slotPlan.slotIndex):
+            # only decode the variables on the paths of the touched slots
+            active = slotPlan.touchedNodes(storageMap)
+
+        stateVariableDict = dict()
+        for var_key, node in slotPlan.variables:
+            tmpValue = self.decodeSlotNode(node, storageMap, slotPlan.mappingKeys, slotPlan, active)
+            if tmpValue != None:
+                stateVariableDict[var_key] = tmpValue
+
+        for var_key, node in slotPlan.mappingVariables:
+            mappingKeys = slotPlan.mappingKeys.union(self.newMappingKeys)
+            extraKeys = self.newMappingKeys.difference(slotPlan.mappingKeys)
+            if len(extraKeys) > 0:
+                slotPlan.newPaths = list()
+                self.expandSlotPlan(node, extraKeys, mappingKeys, slotPlan, ())
+                if active != None:
+                    for slot, path in slotPlan.newPaths:
+                        if slot in storageMap:
+                            slotPlan.activate(active, path)
+            tmpValue = self.decodeSlotNode(node, storageMap, mappingKeys, slotPlan, active)
+            if tmpValue != None:
+                stateVariableDict[var_key] = tmpValue
+        return stateVariableDict
+
+    def decodeSlotNode(self, node, storageMap, mappingKeys, slotPlan, active=None):
+        if active != None and id(node) not in active:
+            return None
+        if node[0] == "value":
+            _, slot, offset, numberOfBytes, label = node
+            tmpValue = self.getSlotValue(slot, offset, numberOfBytes, label, storageMap)
+            if tmpValue != None:
+                # update mappingKeys
+                travelArg(tmpValue, self.newMappingKeys)
+                return (tmpValue, label)
+            return None
+        elif node[0] == "struct":
+            structDict = dict()
+            for var_key, memberNode in node[1]:
+                member_value = self.decodeSlotNode(memberNode, storageMap, mappingKeys, slotPlan, active)
+                if member_value != None:
+                    structDict[var_key] = member_value
+            if structDict != {}:
+                return (structDict,"struct")
+            return None
+        elif node[0] == "mapping":
+            children = node[3]
+            if active == None:
+                keys = mappingKeys
+            elif mappingKeys is slotPlan.mappingKeys:
+                keys = sorted([key for key in active[id(node)] if key in slotPlan.keyOrder], key=slotPlan.keyOrder.get)
+            else:
+                # keep the iteration order of mappingKeys
+                activeKeys = active[id(node)]
+                keys = [key for key in mappingKeys if key in activeKeys]
+            mappingDict = dict()
+            touchedSlot = set()
+            for key in keys:
+                targetSlot, childNode = children[key]
+                if targetSlot != None and targetSlot not in touchedSlot:
+                    touchedSlot.add(targetSlot)
+                    tmpValue = self.decodeSlotNode(childNode, storageMap, mappingKeys, slotPlan, active)
+                    if tmpValue != None:
+                        mappingDict[key] = tmpValue
+            if len(mappingDict) > 0:
+                return (mappingDict, "mapping")
+            return None
+        else:
+            _, slot, stateVariableType, offset, numberOfBytes = node
+            return self.getStateVariable(slot, stateVariableType, offset, numberOfBytes, storageMap, mappingKeys)
+
     def getStateVariableInfo(self, var_type):
         if var_type in self.types:
             stateVariableInfo = self.types[var_type].copy()
@@ -245,6 +484,12 @@ class StateVariableExtractor(object):
             return None
         # print(slot, offset, numOfBytes, var_type)
         slot_value = storageMap[slot]
+        fieldType = getWordFieldType(var_type)
+        if fieldType != None and len(slot_value) == 66 and offset + numOfBytes <= 32:
+            if slot_value not in self.slotWords:
+                self.slotWords[slot_value] = int(slot_value, 16)
+            field = (self.slotWords[slot_value] >> (8 * offset)) & ((1 << (8 * numOfBytes)) - 1)
+            return decodeWordField(fieldType, field)
         value = slot_value[66-2*(offset+numOfBytes):66-2*offset].replace("0x","")
         value = "0" * (64 - len(value)) + value
         # deal with dynamic type
@@ -0,0 +1,86 @@
+from bisect import bisect_right
+
+"""
+the rolling storage of a contract over the replayed calls, each commit is one version
+a slot keeps the versions it was written at and the values, so any version can be read without copying the storage
+"""
+class StorageHistory(object):
+
+    def __init__(self):
+        self.version = 0
+        self.slots = dict() # map slot => ([version], [value]), in the order first written
+        self.slotCounts = [0] # map version => number of slots written up to the version
+
+    def commit(self, storage):
+        self.version += 1
+        for slot, value in storage.items():
+            if slot not in self.slots:
+                self.slots[slot] = (list(), list())
+            versions, values = self.slots[slot]
+            versions.append(self.version)
+            values.append(value)
+        self.slotCounts.append(len(self.slots))
+        return self.version
+
+    def firstVersion(self, slot):
+        if slot in self.slots:
+            return self.slots[slot][0][0]
+        return None
+
+    def get(self, slot, version):
+        # the value of slot at version, None if not written yet
+        if slot not in self.slots:
+            return None
+        versions, values = self.slots[slot]
+        index = bisect_right(versions, version)
+        if index == 0:
+            return None
+        return values[index - 1]
+
+"""
+the storage of a point, read like the storage dict filled from the rolling storage:
+the slots of the point itself, then the slots of the history at version
+"""
+class StorageOverlay(object):
+
+    def __init__(self, storage, history, version):
+        self.storage = storage
+        self.history = history
+        self.version = version
+
+    def inHistory(self, slot):
+        firstVersion = self.history.firstVersion(slot)
+        return firstVersion != None and firstVersion <= self.version
+
+    def __contains__(self, slot):
+        return slot in self.storage or self.inHistory(slot)
+
+    def __getitem__(self, slot):
+        if slot in self.storage:
+            return self.storage[slot]
+        if self.inHistory(slot):
+            return self.history.get(slot, self.version)
+        raise KeyError(slot)
+
+    def get(self, slot, default=None):
+        if slot in self:
+            return self[slot]
+        return default
+
+    def __len__(self):
+        ownInHistory = sum(1 for slot in self.storage if self.inHistory(slot))
+        return len(self.storage) + self.history.slotCounts[self.version] - ownInHistory
+
+    def __iter__(self):
+        for slot in self.storage:
+            yield slot
+        for slot in self.history.slots:
+            if slot not in self.storage and self.inHistory(slot):
+                yield slot
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        for slot in self:
+            yield slot, self[slot]
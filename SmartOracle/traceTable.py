@@ -0,0 +1,120 @@
+from array import array
+from bisect import bisect_left
+
+"""
+interns strings to ints, shared by all the traces of a contract
+"""
+class SymbolTable(object):
+
+    def __init__(self, names=[]):
+        self.ids = dict() # map name => id
+        self.names = list() # map id => name
+        for name in names:
+            self.intern(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, name):
+        if name not in self.ids:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+        return self.ids[name]
+
+    def getId(self, name):
+        return self.ids.get(name)
+
+"""
+a traceDict stored as compact columns, read like the dict of var_name => (value, type) it is built from
+ids and typeCodes point into the SymbolTables of the TraceTable, values keeps the python objects (uint256 does not fit an array)
+sortedIds and positions are the ids in ascending order and their positions in the row, for looking up a name by bisect
+"""
+class TraceRow(object):
+    __slots__ = ("table", "ids", "values", "typeCodes", "sortedIds", "positions")
+
+    def __init__(self, table, ids, values, typeCodes):
+        self.table = table
+        self.ids = ids
+        self.values = values
+        self.typeCodes = typeCodes
+        order = sorted(range(len(ids)), key=ids.__getitem__)
+        self.sortedIds = array("I", [ids[position] for position in order])
+        self.positions = array("I", order)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        names = self.table.symbols.names
+        for id in self.ids:
+            yield names[id]
+
+    def getPosition(self, var_name):
+        id = self.table.symbols.getId(var_name)
+        if id == None:
+            return None
+        index = bisect_left(self.sortedIds, id)
+        if index < len(self.sortedIds) and self.sortedIds[index] == id:
+            return self.positions[index]
+        return None
+
+    def __contains__(self, var_name):
+        return self.getPosition(var_name) != None
+
+    def __getitem__(self, var_name):
+        position = self.getPosition(var_name)
+        if position == None:
+            raise KeyError(var_name)
+        return (self.values[position], self.table.types.names[self.typeCodes[position]])
+
+    def get(self, var_name, default=None):
+        position = self.getPosition(var_name)
+        if position == None:
+            return default
+        return (self.values[position], self.table.types.names[self.typeCodes[position]])
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        names, types = self.table.symbols.names, self.table.types.names
+        for id, var_value, typeCode in zip(self.ids, self.values, self.typeCodes):
+            yield names[id], (var_value, types[typeCode])
+
+    def dump(self):
+        # [ids, values, typeCodes], the names and types are dumped once with the TraceTable
+        return [list(self.ids), list(self.values), list(self.typeCodes)]
+
+"""
+the symbol tables of the var_names and types in the traces of a contract
+"""
+class TraceTable(object):
+
+    def __init__(self):
+        self.symbols = SymbolTable()
+        self.types = SymbolTable()
+
+    def makeRow(self, traceDict):
+        if isinstance(traceDict, TraceRow):
+            return traceDict
+        ids = array("I")
+        values = list()
+        typeCodes = array("H")
+        for var_name, (var_value, var_type) in traceDict.items():
+            ids.append(self.symbols.intern(var_name))
+            values.append(var_value)
+            typeCodes.append(self.types.intern(var_type))
+        return TraceRow(self, ids, tuple(values), typeCodes)
+
+    def dump(self, dtraceList):
+        dumpedList = list()
+        for dtrace in dtraceList:
+            dumpedDtrace = dict(dtrace)
+            if isinstance(dtrace["traceDict"], TraceRow):
+                dumpedDtrace["traceDict"] = dtrace["traceDict"].dump()
+            dumpedList.append(dumpedDtrace)
+        return {
+            "symbols": self.symbols.names,
+            "types": self.types.names,
+            "dtraces": dumpedList,
+        }
@@ -0,0 +1,95 @@
+import os
+import json
+import pickle
+import fcntl
+
+"""
+segmented cache of the var_dicts read from the tx files
+each segment holds the pickled var_dict lists of the txs added in one run, appended back to back
+index.json maps block_tx => [segment, offset, length], so a run only reads the txs it asks for
+the writers of a store take its lock file, so concurrent tasks on the same outputPath do not overwrite each other's segments
+pickle keeps the uint256 values, which do not fit msgpack integers
+"""
+class VarDictStore(object):
+
+    def __init__(self, outputPath, mode):
+        self.path = f"{outputPath}/{mode}_var_dict"
+        self.indexPath = f"{self.path}/index.json"
+        self.lockPath = f"{self.path}/lock"
+        self.segments = list()
+        self.txIndex = dict()
+        self.loadIndex()
+
+    def loadIndex(self):
+        if os.path.exists(self.indexPath):
+            with open(self.indexPath, "r") as f:
+                index = json.load(f)
+            self.segments = index["segments"]
+            self.txIndex = index["txs"]
+
+    def __contains__(self, block_tx):
+        return block_tx in self.txIndex
+
+    def __len__(self):
+        return len(self.txIndex)
+
+    def exists(self):
+        return os.path.exists(self.indexPath)
+
+    def load(self, block_tx_list):
+        # group by segment and read each segment once, in the order of offset
+        segmentDict = dict()
+        for block_tx in block_tx_list:
+            if block_tx in self.txIndex:
+                segment, offset, length = self.txIndex[block_tx]
+                if segment not in segmentDict:
+                    segmentDict[segment] = list()
+                segmentDict[segment].append((offset, length, block_tx))
+
+        txDict = dict()
+        for segment, records in segmentDict.items():
+            records.sort()
+            with open(f"{self.path}/{self.segments[segment]}", "rb") as f:
+                for offset, length, block_tx in records:
+                    f.seek(offset)
+                    txDict[block_tx] = pickle.loads(f.read(length))
+        return txDict
+
+    def append(self, txDict):
+        # txDict: block_tx => var_dict_list, only writes a new segment and the index
+        if len(txDict) == 0:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.lockPath, "w") as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            # another writer may have added segments since this store was opened
+            self.loadIndex()
+            segment = len(self.segments)
+            segmentName = f"segment_{segment}.pkl"
+            newIndex = dict()
+            with open(f"{self.path}/{segmentName}", "wb") as f:
+                for block_tx, var_dict_list in txDict.items():
+                    data = pickle.dumps(var_dict_list, protocol=pickle.HIGHEST_PROTOCOL)
+                    newIndex[block_tx] = [segment, f.tell(), len(data)]
+                    f.write(data)
+            self.segments.append(segmentName)
+            self.txIndex.update(newIndex)
+            self.dumpIndex()
+
+    def dumpIndex(self):
+        tmpPath = f"{self.indexPath}.tmp"
+        with open(tmpPath, "w") as f:
+            json.dump({"segments": self.segments, "txs": self.txIndex}, f)
+        os.replace(tmpPath, self.indexPath)
+
+    def importJson(self, jsonPath):
+        # migrate the old {mode}_var_dict.json
+        with open(jsonPath, "r") as f:
+            var_dict_list = json.load(f)
+        txDict = dict()
+        for var_dict in var_dict_list:
+            block_tx = f'{var_dict["blockNumber"]}_{var_dict["position"]}'
+            if block_tx not in txDict:
+                txDict[block_tx] = list()
+            txDict[block_tx].append(var_dict)
+        self.append(txDict)